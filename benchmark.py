@@ -0,0 +1,467 @@
+"""
+Offline benchmarks for the queue, extraction and playback paths of `bot.py`.
+
+Nothing here touches the network: yt-dlp is replaced by a fake extractor with configurable
+latency, FFmpeg by fake audio sources and Discord's voice client by a fake that reads frames
+at the real 20 ms pace. Results can be saved with `--json` and compared across commits with
+`--compare`, e.g.:
+
+    python benchmark.py --json before.json
+    git checkout my-branch
+    python benchmark.py --compare before.json
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import random
+import subprocess
+import threading
+import time
+import tracemalloc
+from urllib.parse import urlparse, parse_qs
+
+import discord
+
+import bot
+
+
+class FakeYoutubeDL:
+    # Seconds per `extract_info` call, and per page of a lazily loaded playlist
+    LATENCY = 0.05
+    PAGE_LATENCY = 0.02
+    PAGE_SIZE = 100
+    PLAYLIST_SIZE = 500
+    # Frames per track, each being 20 ms
+    TRACK_FRAMES = 100
+
+    def extract_info(self, url: str, download: bool = False, process: bool = True):
+        time.sleep(self.LATENCY)
+
+        if url.startswith("ytsearch:"):
+            return {"entries": [self.video(url[len("ytsearch:"):].replace(" ", "-"))]}
+
+        query = parse_qs(urlparse(url).query)
+
+        if "list" in query:
+            return {"title": "Playlist", "entries": self.entries(int(query.get("size", [self.PLAYLIST_SIZE])[0]))}
+
+        return self.video(query.get("v", ["video"])[0])
+
+    def entries(self, size: int):
+        for i in range(size):
+            if i % self.PAGE_SIZE == 0:
+                time.sleep(self.PAGE_LATENCY)
+
+            # What flat playlist entries look like, plus some of the bulk real ones carry around
+            yield {
+                "_type": "url",
+                "ie_key": "Youtube",
+                "id": f"entry{i}",
+                "url": f"https://www.youtube.com/watch?v=entry{i}",
+                "title": f"Playlist entry number {i}",
+                "duration": self.TRACK_FRAMES * 0.02,
+                "thumbnails": [{"url": f"https://i.ytimg.com/vi/entry{i}/{size}.jpg"} for size in range(8)],
+                "description": "Lorem ipsum " * 40,
+            }
+
+    def video(self, video_id: str):
+        return {
+            "id": video_id,
+            "title": f"Video {video_id}",
+            "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+            "url": f"fake://{video_id}?frames={self.TRACK_FRAMES}&expire={int(time.time()) + 6 * 60 * 60}",
+            "duration": self.TRACK_FRAMES * 0.02,
+            "thumbnail": f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg",
+            "acodec": "opus",
+            "formats": [{"format_id": str(i), "url": f"fake://{video_id}/{i}", "tbr": i} for i in range(30)],
+        }
+
+
+class FakeAudio(discord.AudioSource):
+    # Seconds until the first frame, standing in for FFmpeg starting, connecting and probing
+    STARTUP = 0.15
+    OPUS = True
+
+    def __init__(self, source: str, **kwargs):
+        parsed = urlparse(source)
+        self.track = parsed.netloc.encode()
+        self.frames = int(parse_qs(parsed.query).get("frames", [FakeYoutubeDL.TRACK_FRAMES])[0])
+        self.started = False
+
+    def read(self) -> bytes:
+        if not self.started:
+            time.sleep(self.STARTUP)
+            self.started = True
+
+        if self.frames == 0:
+            return b""
+
+        self.frames -= 1
+        return self.track if self.OPUS else self.track.ljust(3840, b"\0")
+
+    def is_opus(self) -> bool:
+        return self.OPUS
+
+
+class FakePCMAudio(FakeAudio):
+    OPUS = False
+
+
+class FakeVoiceClient:
+    # Reads frames like `discord.player.AudioPlayer`, recording when each track's frames arrive
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.channel = FakeChannel()
+        self.frames = []  # (timestamp, track)
+        self.first_frame = loop.create_future()
+        self._source = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._paused = False
+
+    @property
+    def source(self):
+        return self._source
+
+    @source.setter
+    def source(self, value):
+        self._source = value
+
+    def play(self, source: discord.AudioSource, after=None):
+        self._source = source
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(after,), daemon=True)
+        self._thread.start()
+
+    def _run(self, after):
+        start, loops = time.perf_counter(), 0
+
+        while not self._stopped.is_set():
+            data = self._source.read()
+
+            if not data:
+                break
+
+            now = time.perf_counter()
+            self.frames.append((now, data.rstrip(b"\0")))
+
+            if not self.first_frame.done():
+                self.loop.call_soon_threadsafe(lambda: self.first_frame.done() or self.first_frame.set_result(now))
+
+            loops += 1
+            time.sleep(max(0, start + 0.02 * loops - time.perf_counter()))
+
+        self._source.cleanup()
+
+        if after is not None:
+            after(None)
+
+    def is_playing(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._paused
+
+    def is_paused(self) -> bool:
+        return self._paused
+
+    def is_connected(self) -> bool:
+        return True
+
+    def stop(self):
+        self._stopped.set()
+
+    async def disconnect(self, force: bool = False):
+        self.stop()
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+
+class FakeChannel:
+    def __init__(self, guild_id: int = 1):
+        self.id = guild_id
+        self.guild = FakeGuild(guild_id)
+
+    async def send(self, *args, **kwargs):
+        pass
+
+
+class FakeContext:
+    def __init__(self, guild_id: int = 1):
+        self.author = "benchmark"
+        self.channel = FakeChannel(guild_id)
+        self.guild = self.channel.guild
+
+
+class FakeBot:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+    def is_closed(self) -> bool:
+        return False
+
+
+def reset():
+    bot.YTDLSource.cache = bot.ExtractionCache()
+    bot.metrics = bot.Metrics()
+
+
+async def bench_enqueue(args) -> dict:
+    # `/play` with distinct searches, resolved concurrently like separate commands would be
+    reset()
+    loop = asyncio.get_running_loop()
+    songs = bot.SongQueue()
+    ctx = FakeContext()
+
+    async def play(target):
+        for source in await bot.YTDLSource.prepare_sources(ctx, target, loop):
+            await songs.put(bot.Song(source))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(play(f"song number {i}") for i in range(args.plays)))
+    elapsed = time.perf_counter() - start
+
+    # The same searches again, now all cache hits
+    start = time.perf_counter()
+    await asyncio.gather(*(play(f"song number {i}") for i in range(args.plays)))
+    cached = time.perf_counter() - start
+
+    # Everybody pasting the same link at once
+    start = time.perf_counter()
+    await asyncio.gather(*(play("the same song") for _ in range(args.plays)))
+    duplicate = time.perf_counter() - start
+
+    return {
+        "enqueue_per_second": args.plays / elapsed,
+        "enqueue_cached_per_second": args.plays / cached,
+        "enqueue_duplicate_per_second": args.plays / duplicate,
+    }
+
+
+async def bench_playlist(args) -> dict:
+    reset()
+    loop = asyncio.get_running_loop()
+    songs = bot.SongQueue()
+    ctx = FakeContext()
+    url = f"https://www.youtube.com/playlist?list=benchmark&size={args.playlist}"
+
+    start = time.perf_counter()
+    first = None
+
+    async for sources in bot.YTDLSource.iter_sources(ctx, url, loop):
+        for source in sources:
+            await songs.put(bot.Song(source))
+
+        if first is None:
+            first = time.perf_counter() - start
+
+    return {
+        "playlist_first_song_seconds": first,
+        "playlist_total_seconds": time.perf_counter() - start,
+    }
+
+
+async def bench_queue_operations(args) -> dict:
+    rng = random.Random(42)
+    songs = bot.SongQueue()
+    size = args.queue_size
+
+    for i in range(size):
+        songs.put_nowait(i)
+
+    def timed(operation) -> float:
+        start = time.perf_counter()
+
+        for _ in range(args.operations):
+            operation()
+
+        return (time.perf_counter() - start) / args.operations * 1e6
+
+    start = time.perf_counter()
+
+    for _ in range(args.operations):
+        await songs.move(rng.randrange(size), rng.randrange(size))
+
+    results = {
+        "queue_move_microseconds": (time.perf_counter() - start) / args.operations * 1e6,
+        "queue_slice_microseconds": timed(lambda: songs[(start := rng.randrange(size - 10)):start + 10]),
+        "queue_index_microseconds": timed(lambda: songs[rng.randrange(size)]),
+    }
+
+    # Keep the size stable while removing
+    def remove():
+        songs.remove(rng.randrange(len(songs)))
+        songs.put_nowait(0)
+
+    results["queue_remove_microseconds"] = timed(remove)
+
+    return results
+
+
+async def bench_playback(args) -> dict:
+    # Time to first audio after `/play`, and the gaps between queued songs
+    reset()
+    loop = asyncio.get_running_loop()
+    ctx = FakeContext()
+    first_audio = []
+
+    for run in range(args.runs):
+        state = bot.VoiceState(FakeBot(loop), 1, ctx)
+        voice = state.voice = FakeVoiceClient(loop)
+
+        start = time.perf_counter()
+
+        for source in await bot.YTDLSource.prepare_sources(ctx, f"first audio {run}", loop):
+            await state.songs.put(bot.Song(source))
+
+        first_audio.append(await voice.first_frame - start)
+        await state.close()
+
+    results = {"first_audio_seconds": sum(first_audio) / len(first_audio)}
+    lead = bot.VoiceState.GAPLESS_LEAD
+
+    # With the next song lined up ahead of time, then with it only starting once the previous one ended
+    for name, bot.VoiceState.GAPLESS_LEAD in (("transition_gap", lead), ("transition_gap_sequential", -1)):
+        gaps = await transition_gaps(loop, ctx, args.tracks, name)
+        results[f"{name}_seconds"] = sum(gaps) / len(gaps) if gaps else float("nan")
+        results[f"{name}_max_seconds"] = max(gaps, default=float("nan"))
+
+    bot.VoiceState.GAPLESS_LEAD = lead
+    # From a track ending on the audio thread until the event loop picks it up
+    results["handoff_seconds"] = bot.metrics.stages().get("handoff", {}).get("average", float("nan"))
+    return results
+
+
+async def transition_gaps(loop: asyncio.AbstractEventLoop, ctx: FakeContext, tracks: int, name: str) -> list:
+    state = bot.VoiceState(FakeBot(loop), 1, ctx)
+    voice = state.voice = FakeVoiceClient(loop)
+
+    for i in range(tracks):
+        for source in await bot.YTDLSource.prepare_sources(ctx, f"{name} {i}", loop):
+            await state.songs.put(bot.Song(source))
+
+    # Until the last track's frames all went out
+    deadline = time.perf_counter() + tracks * (FakeYoutubeDL.TRACK_FRAMES * 0.02 + 5)
+
+    while len(voice.frames) < tracks * FakeYoutubeDL.TRACK_FRAMES and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+
+    await state.close()
+
+    gaps = []
+    frames = voice.frames
+
+    for (previous_time, previous_track), (frame_time, track) in zip(frames, frames[1:]):
+        if track != previous_track:
+            # Minus the regular pace between frames
+            gaps.append(max(frame_time - previous_time - 0.02, 0))
+
+    return gaps
+
+
+async def bench_memory(args) -> dict:
+    reset()
+    loop = asyncio.get_running_loop()
+    ctx = FakeContext()
+    url = f"https://www.youtube.com/playlist?list=memory&size={args.memory_songs}"
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    songs = bot.SongQueue()
+
+    async for sources in bot.YTDLSource.iter_sources(ctx, url, loop):
+        for source in sources:
+            songs.put_nowait(bot.Song(source))
+
+    # Only what the queue itself keeps alive
+    reset()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return {"memory_per_song_bytes": (after - before) / len(songs)}
+
+
+# Whether a bigger value is an improvement
+HIGHER_IS_BETTER = {"enqueue_per_second", "enqueue_cached_per_second", "enqueue_duplicate_per_second"}
+
+
+def compare(results: dict, baseline: dict):
+    print(f"\n{'metric':<40}{'baseline':>14}{'current':>14}{'change':>10}")
+
+    for name, value in results.items():
+        old = baseline.get(name)
+
+        if old is None or not old:
+            print(f"{name:<40}{'-':>14}{value:>14.4g}{'':>10}")
+            continue
+
+        change = (value - old) / old * 100
+        better = change > 0 if name in HIGHER_IS_BETTER else change < 0
+        marker = "" if abs(change) < 5 else (" +" if better else " !")
+        print(f"{name:<40}{old:>14.4g}{value:>14.4g}{change:>+9.1f}%{marker}")
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return "unknown"
+
+
+async def main(args):
+    bot._get_ytdl = FakeYoutubeDL
+    discord.FFmpegOpusAudio = FakeAudio
+    discord.FFmpegPCMAudio = FakePCMAudio
+
+    FakeYoutubeDL.LATENCY = args.latency
+    FakeAudio.STARTUP = args.startup
+    random.seed(42)
+
+    results = {}
+    results.update(await bench_enqueue(args))
+    results.update(await bench_playlist(args))
+    results.update(await bench_queue_operations(args))
+    results.update(await bench_playback(args))
+    results.update(await bench_memory(args))
+
+    bot.YTDLSource.engine.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per fake extract_info call")
+    parser.add_argument("--startup", type=float, default=0.15, help="seconds until a fake FFmpeg's first frame")
+    parser.add_argument("--plays", type=int, default=200, help="searches for the enqueue benchmark")
+    parser.add_argument("--playlist", type=int, default=2000, help="entries of the ingested playlist")
+    parser.add_argument("--queue-size", type=int, default=10000, help="songs in the queue operations benchmark")
+    parser.add_argument("--operations", type=int, default=2000, help="repetitions of every queue operation")
+    parser.add_argument("--runs", type=int, default=5, help="repetitions of the time to first audio benchmark")
+    parser.add_argument("--tracks", type=int, default=4, help="tracks played for the transition benchmark")
+    parser.add_argument("--memory-songs", type=int, default=5000, help="songs queued for the memory benchmark")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="compare against results previously written with --json")
+    args = parser.parse_args()
+
+    results = asyncio.run(main(args))
+
+    for name, value in results.items():
+        print(f"{name:<40}{value:>14.4g}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(
+                {"revision": git_revision(), "python": platform.python_version(), "results": results},
+                file,
+                indent=2,
+            )
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file)["results"])
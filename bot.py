@@ -1,27 +1,54 @@
 import asyncio
+import audioop
+import bisect
+import contextlib
 import functools
+import hashlib
+import hmac
+import importlib
 import itertools
+import json
 import math
+import multiprocessing
 import random
 import os
-
+import re
+import secrets
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import aiohttp
 import discord
-import yt_dlp
-import lyricsgenius
+from aiohttp import web
 from discord.ext import commands
 from async_timeout import timeout
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse, parse_qs, parse_qsl, urlencode
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 import datetime
 
-from typing import Dict, List
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
 from dotenv import load_dotenv
 
-# Suppress noise about console usage from errors
-yt_dlp.utils.bug_reports_message = lambda: ""
+# yt-dlp, BeautifulSoup and mutagen are imported where they're used, they'd slow down
+# startup and aren't needed until the first `/play` (or they're warmed up after `on_ready`).
+if TYPE_CHECKING:
+    import yt_dlp
+
+# Load early so class-level settings below can be configured through `.env`
+load_dotenv()
+
+# Fallback for `Metrics.process_age`
+_loaded_at = time.monotonic()
 
 class Timer():
-    def __init__(self):
-        self.start_date = datetime.datetime.now()
+    def __init__(self, offset: float = 0):
+        self.start_date = datetime.datetime.now() - datetime.timedelta(seconds=offset)
         self.paused_date = None
         self.is_paused = False
 
@@ -46,10 +73,826 @@ class Timer():
         return seconds_elapsed
         
 
+class Metrics:
+    # Upper bounds of the latency histogram buckets, in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    # Serves `/metrics` in the Prometheus text format on localhost, 0 disables it
+    PORT = int(os.getenv("METRICS_PORT", "0"))
+    HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+    def __init__(self):
+        # Observed from the audio threads too
+        self._lock = threading.Lock()
+        # stage -> [count per bucket (the last one being +Inf)..., sum]
+        self._histograms: Dict[str, list] = {}
+        # name -> (help, type, callback), where callbacks return a value or a list of (labels, value)
+        self._gauges: Dict[str, tuple] = {}
+        self._runner: web.AppRunner = None
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+
+            if histogram is None:
+                histogram = self._histograms[stage] = [0] * (len(self.BUCKETS) + 2)
+
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(self.BUCKETS)] += 1
+
+            histogram[-1] += seconds
+
+    @contextlib.contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def gauge(self, name: str, help: str, callback, kind: str = "gauge"):
+        self._gauges[name] = (help, kind, callback)
+
+    def histograms(self) -> Dict[str, list]:
+        with self._lock:
+            return {stage: list(histogram) for stage, histogram in self._histograms.items()}
+
+    def snapshot(self) -> Dict:
+        # What `merge` takes, for adding up the metrics of several processes
+        return {"histograms": self.histograms(), "values": self.values()}
+
+    @staticmethod
+    def merge(snapshots: List[Dict]) -> Dict:
+        histograms, values = {}, {}
+
+        for snapshot in snapshots:
+            for stage, histogram in snapshot["histograms"].items():
+                merged = histograms.setdefault(stage, [0] * len(histogram))
+                histograms[stage] = [a + b for a, b in zip(merged, histogram)]
+
+            for name, labeled in snapshot["values"].items():
+                merged = values.setdefault(name, {})
+
+                for labels, value in labeled:
+                    key = tuple(sorted(labels.items()))
+                    merged[key] = merged.get(key, 0) + value
+
+        return {
+            "histograms": histograms,
+            "values": {name: [(dict(key), value) for key, value in merged.items()] for name, merged in values.items()},
+        }
+
+    def stages(self, histograms: Dict[str, list] = None) -> Dict[str, Dict[str, float]]:
+        if histograms is None:
+            histograms = self.histograms()
+
+        stages = {}
+
+        for stage, histogram in sorted(histograms.items()):
+            count = sum(histogram[:-1])
+            # Upper bound of the bucket the 95th percentile falls into
+            p95, seen = float("inf"), 0
+
+            for bound, bucket in zip(self.BUCKETS, histogram):
+                seen += bucket
+
+                if seen >= 0.95 * count:
+                    p95 = bound
+                    break
+
+            stages[stage] = {"count": count, "average": histogram[-1] / count if count else 0, "p95": p95}
+
+        return stages
+
+    def values(self) -> Dict[str, list]:
+        values = {}
+
+        for name, (_, _, callback) in self._gauges.items():
+            value = callback()
+            values[name] = value if isinstance(value, list) else [({}, value)]
+
+        return values
+
+    def render(self) -> str:
+        lines = [
+            "# HELP musicbot_stage_seconds Latency of playback pipeline stages.",
+            "# TYPE musicbot_stage_seconds histogram",
+        ]
+
+        for stage, histogram in sorted(self.histograms().items()):
+            cumulative = 0
+
+            for bound, bucket in zip(self.BUCKETS + ("+Inf",), histogram):
+                cumulative += bucket
+                lines.append(f'musicbot_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+
+            lines.append(f'musicbot_stage_seconds_sum{{stage="{stage}"}} {histogram[-1]}')
+            lines.append(f'musicbot_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+
+        values = self.values()
+
+        for name, (help, kind, _) in self._gauges.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            for labels, value in values[name]:
+                label_string = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f"{name}{{{label_string}}} {value}" if label_string else f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int):
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        print(f"Serving metrics on http://{host}:{port}/metrics")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @staticmethod
+    def process_age() -> float:
+        # Seconds since the process started, imports included, where `/proc` says so
+        try:
+            with open("/proc/self/stat") as file:
+                # Field 22 is the start time in clock ticks since boot, counted after the parenthesized name
+                started_at = int(file.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+
+            with open("/proc/uptime") as file:
+                return float(file.read().split()[0]) - started_at
+        except (OSError, ValueError, IndexError):
+            return time.monotonic() - _loaded_at
+
+
+# Shared by everything that gets measured
+metrics = Metrics()
+
+
 class YTDLError(Exception):
     pass
 
 
+class ExtractionCache:
+    # Searches and URL metadata stay valid much longer than signed stream URLs
+    METADATA_TTL = int(os.getenv("EXTRACTION_METADATA_TTL", "21600"))
+    # Used for stream URLs that don't carry their own expiry
+    STREAM_TTL = int(os.getenv("EXTRACTION_STREAM_TTL", "1800"))
+    # Stop handing out stream URLs this many seconds before they expire
+    STREAM_EXPIRY_MARGIN = 300
+    MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_SIZE", "4096"))
+
+    # Only these survive in cached metadata, full info dicts can be tens of KB each
+    METADATA_KEYS = ("title", "webpage_url", "url", "id", "ie_key", "extractor", "duration", "thumbnail")
+    # Query parameters that don't change what a URL points to
+    TRACKING_PARAMS = {"si", "feature", "pp", "app", "utm_source", "utm_medium", "utm_campaign"}
+
+    def __init__(self, max_entries: int = None):
+        self.max_entries = max_entries or self.MAX_ENTRIES
+
+        # key -> (expires_at, value), ordered from least to most recently used
+        self._entries: OrderedDict[str, tuple] = OrderedDict()
+        # Counted per key kind (the part of the key before the first colon)
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> Any:
+        kind = key.split(":", 1)[0]
+        entry = self._entries.get(key)
+
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                del self._entries[key]
+
+            self.misses[kind] += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits[kind] += 1
+        return entry[1]
+
+    def put(self, key: str, value: Any, ttl: float):
+        if ttl <= 0:
+            return
+
+        self._entries[key] = (time.time() + ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            kind: {"hits": self.hits[kind], "misses": self.misses[kind]}
+            for kind in sorted(set(self.hits) | set(self.misses))
+        }
+
+    @classmethod
+    def trim(cls, data: Dict) -> Dict:
+        return {key: data[key] for key in cls.METADATA_KEYS if data.get(key) is not None}
+
+    @classmethod
+    def stream_ttl(cls, expires_at: Optional[float]) -> float:
+        if expires_at is None:
+            return cls.STREAM_TTL
+
+        return expires_at - time.time() - cls.STREAM_EXPIRY_MARGIN
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    @classmethod
+    def normalize_url(cls, url: str) -> str:
+        parsed = urlparse(url.strip())
+        netloc = parsed.netloc.lower()
+        path = parsed.path.rstrip("/")
+
+        for prefix in ("www.", "m."):
+            if netloc.startswith(prefix):
+                netloc = netloc[len(prefix):]
+
+        query = [(key, value) for key, value in parse_qsl(parsed.query) if key not in cls.TRACKING_PARAMS]
+
+        # Short links point to the same videos as the long ones
+        if netloc == "youtu.be" and path:
+            query.append(("v", path[1:]))
+            netloc, path = "youtube.com", "/watch"
+
+        return urlunparse(("https", netloc, path, "", urlencode(sorted(query)), ""))
+
+    @staticmethod
+    def parse_stream_expiry(stream_url: str) -> Optional[float]:
+        # UNIX timestamp of when a signed stream URL stops working, if it says so
+        parsed = urlparse(stream_url)
+        params = parse_qs(parsed.query)
+
+        for key in ("expire", "expires", "Expires"):
+            if key in params and params[key][0].isdigit():
+                return float(params[key][0])
+
+        # Some manifests have it as a path segment instead
+        match = re.search(r"/expire/(\d+)", parsed.path)
+        return float(match.group(1)) if match else None
+
+
+class SingleFlight:
+    # Lets concurrent calls for the same key share one in-flight task instead of each
+    # doing the same work. Results aren't kept, that's what the caches are for.
+
+    def __init__(self):
+        # key -> [task, number of callers waiting for it]
+        self._calls: Dict[str, list] = {}
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def run(self, key: str, func, *args) -> Any:
+        call = self._calls.get(key)
+
+        if call is None:
+            task = asyncio.get_running_loop().create_task(func(*args))
+            call = self._calls[key] = [task, 0]
+            task.add_done_callback(functools.partial(self._on_done, key))
+        else:
+            self.coalesced += 1
+
+        task = call[0]
+        call[1] += 1
+
+        try:
+            # Shielded, so one caller getting cancelled doesn't cancel it for everybody else
+            return await asyncio.shield(task)
+        finally:
+            call[1] -= 1
+
+            if call[1] == 0 and not task.done():
+                # Nobody's waiting for it anymore, which also drops it from the extraction backlog.
+                # Forgotten right away, so the next caller starts over instead of joining a dying task.
+                task.cancel()
+                self._forget(key, task)
+
+    def _forget(self, key: str, task: asyncio.Task):
+        call = self._calls.get(key)
+
+        if call is not None and call[0] is task:
+            del self._calls[key]
+
+    def _on_done(self, key: str, task: asyncio.Task):
+        # Failures aren't remembered, the next call after this one tries again
+        self._forget(key, task)
+
+        if not task.cancelled():
+            # Retrieved, so it isn't logged as never retrieved if every caller was cancelled
+            task.exception()
+
+
+class SharedEntries:
+    # Entries of a playlist shared by concurrent imports of it, fetched
+    # (and trimmed) once by whichever import gets to a batch first.
+
+    def __init__(self, entries: Iterator[Dict], lazy: bool, worker: int = None):
+        self._entries = entries
+        self._lazy = lazy
+        # The extraction worker lazy entries have to be fetched on
+        self.worker = worker
+        # Only one fetch at a time, a generator can't be iterated from two workers at once
+        self._fetching: asyncio.Task = None
+        self.fetched: List[Dict] = []
+        self.exhausted = False
+
+    async def batch(self, start: int, size: int, fetch) -> List[Dict]:
+        while len(self.fetched) < start + size and not self.exhausted:
+            if self._fetching is None:
+                missing = start + size - len(self.fetched)
+                self._fetching = asyncio.get_running_loop().create_task(self._fetch(missing, fetch))
+
+            # Kept going if this import gets cancelled, the others still want the entries
+            await asyncio.shield(self._fetching)
+
+        return self.fetched[start:start + size]
+
+    async def _fetch(self, size: int, fetch):
+        try:
+            # Lazy entries fetch more pages while being iterated, `fetch` runs that on a worker
+            batch = await fetch(self._entries, size, self.worker) if self._lazy else _next_batch(self._entries, size)
+
+            self.exhausted = len(batch) < size
+            self.fetched.extend(ExtractionCache.trim(entry) for entry in batch if entry)
+        finally:
+            self._fetching = None
+
+
+# Each extraction worker (thread or process) gets its own YoutubeDL, they aren't thread-safe
+_worker_state = threading.local()
+
+
+def _init_worker(worker: int):
+    # Extraction threads know which one they are, so lazy results can name the worker they belong to
+    _worker_state.index = worker
+
+
+def _get_ytdl() -> "yt_dlp.YoutubeDL":
+    ytdl = getattr(_worker_state, "ytdl", None)
+
+    if ytdl is None:
+        import yt_dlp
+
+        # Suppress noise about console usage from errors
+        yt_dlp.utils.bug_reports_message = lambda: ""
+        ytdl = _worker_state.ytdl = yt_dlp.YoutubeDL(YTDLSource.YTDL_OPTIONS)
+
+    return ytdl
+
+
+def _warm_up():
+    _get_ytdl()
+
+
+def _extract_info(url: str, process: bool = True, materialize: bool = False) -> Optional[Dict]:
+    data = _get_ytdl().extract_info(url, download=False, process=process)
+
+    if materialize and data and data.get("entries") is not None:
+        # Generators can't be sent back from a worker process
+        data["entries"] = list(data["entries"])
+    elif data and data.get("entries") is not None and not isinstance(data["entries"], (list, tuple)):
+        # Lazy entries keep using this worker's YoutubeDL while being iterated
+        data["_worker"] = getattr(_worker_state, "index", None)
+
+    return data
+
+
+def _next_batch(entries: Iterator[Dict], size: int) -> List[Dict]:
+    # Lazy playlist entries fetch more pages while being iterated, so this runs on
+    # the worker that extracted them (see `ExtractionEngine.run`)
+    return list(itertools.islice(entries, size))
+
+
+class ExtractionEngine:
+    WORKERS = int(os.getenv("EXTRACTION_WORKERS", "4"))
+    # Either "thread" or "process", the latter keeps heavy playlist and format parsing off the GIL
+    MODE = os.getenv("EXTRACTION_MODE", "thread")
+
+    def __init__(self, workers: int = None, mode: str = None):
+        self.workers = workers or self.WORKERS
+        self.mode = mode or self.MODE
+
+        if self.mode not in ("thread", "process"):
+            raise ValueError(f"Unknown extraction mode {self.mode!r}")
+
+        # In thread mode every worker is an executor of its own, so jobs can be sent back to the worker whose
+        # YoutubeDL they need (like the next pages of a lazy playlist). Processes share one pool, nothing
+        # lazy comes back from them.
+        self._executors: Dict[int, Executor] = {}
+        self._pool: Executor = None
+        self._idle: List[int] = list(range(self.workers))
+        # Pending jobs per guild, served round-robin so a huge playlist import
+        # in one guild can't starve everybody else's `/play`.
+        self._pending: OrderedDict[Any, deque] = OrderedDict()
+        # Jobs nobody is waiting on right now, only run when nothing else is pending
+        self._background: deque = deque()
+        # worker -> jobs that have to run on that one, ahead of everything else
+        self._pinned: Dict[int, deque] = {}
+
+    @property
+    def backlog(self) -> int:
+        pinned = sum(len(jobs) for jobs in self._pinned.values())
+        return sum(len(jobs) for jobs in self._pending.values()) + len(self._background) + pinned
+
+    @property
+    def running(self) -> int:
+        return self.workers - len(self._idle)
+
+    def executor(self, worker: int) -> Executor:
+        if self.mode == "process":
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+
+            return self._pool
+
+        if worker not in self._executors:
+            self._executors[worker] = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=f"ytdl-{worker}", initializer=_init_worker, initargs=(worker,)
+            )
+
+        return self._executors[worker]
+
+    def warm_up(self, loop: asyncio.BaseEventLoop) -> asyncio.Future:
+        # One job per worker, so each of them has its YoutubeDL ready before the first `/play`
+        return asyncio.gather(*(self.run(loop, None, _warm_up) for _ in range(self.workers)))
+
+    async def extract_info(
+        self, loop: asyncio.BaseEventLoop, guild_id: Any, url: str, process: bool = True, background: bool = False
+    ) -> Dict:
+        materialize = self.mode == "process"
+        return await self.run(loop, guild_id, _extract_info, url, process, materialize, background=background)
+
+    async def run(
+        self, loop: asyncio.BaseEventLoop, guild_id: Any, func, *args, background: bool = False, worker: int = None
+    ) -> Any:
+        # `worker` pins the job to that worker, see `_extract_info`
+        future = loop.create_future()
+
+        if worker is not None:
+            self._pinned.setdefault(worker, deque()).append((future, func, args))
+        elif background:
+            self._background.append((future, func, args))
+        else:
+            self._pending.setdefault(guild_id, deque()).append((future, func, args))
+
+        self._dispatch(loop)
+
+        return await future
+
+    def _dispatch(self, loop: asyncio.BaseEventLoop):
+        for worker in [worker for worker in self._idle if worker in self._pinned]:
+            jobs = self._pinned[worker]
+
+            while jobs:
+                future, func, args = jobs.popleft()
+
+                if not future.done():
+                    self._start(loop, worker, future, func, args)
+                    break
+
+            if not jobs:
+                del self._pinned[worker]
+
+        while self._idle:
+            if self._pending:
+                guild_id, jobs = next(iter(self._pending.items()))
+                future, func, args = jobs.popleft()
+
+                # Put the guild at the back of the line
+                if jobs:
+                    self._pending.move_to_end(guild_id)
+                else:
+                    del self._pending[guild_id]
+            elif self._background and self.running < max(self.workers - 1, 1):
+                # Always leaving a worker free for whoever runs `/play` next
+                future, func, args = self._background.popleft()
+            else:
+                break
+
+            if future.done():
+                # Cancelled while waiting for its turn
+                continue
+
+            self._start(loop, self._idle[-1], future, func, args)
+
+    def _start(self, loop: asyncio.BaseEventLoop, worker: int, future: asyncio.Future, func, args: tuple):
+        self._idle.remove(worker)
+        work = loop.run_in_executor(self.executor(worker), func, *args)
+        work.add_done_callback(functools.partial(self._on_done, loop, worker, future))
+
+    def _on_done(self, loop: asyncio.BaseEventLoop, worker: int, future: asyncio.Future, work: asyncio.Future):
+        self._idle.append(worker)
+
+        if not future.done():
+            if work.cancelled():
+                future.cancel()
+            elif work.exception() is not None:
+                future.set_exception(work.exception())
+            else:
+                future.set_result(work.result())
+
+        self._dispatch(loop)
+
+    def close(self):
+        for executor in [*self._executors.values(), self._pool]:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        self._executors.clear()
+        self._pool = None
+
+
+class AudioCache:
+    # Directory of the cache, an empty string disables it. Loudness normalization (`LoudnessIndex`) needs it too.
+    PATH = os.getenv("AUDIO_CACHE_PATH", "")
+    MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+    # Concurrent FFmpeg processes filling the cache
+    FILL_WORKERS = 2
+    BITRATE = "128k"
+    # Long mixes and livestreams would just push everything else out
+    MAX_DURATION = 20 * 60
+
+    def __init__(self, path: str, max_bytes: int = None):
+        self.path = path
+        self.max_bytes = max_bytes or self.MAX_BYTES
+
+        # key -> file size, ordered from least to most recently played
+        self._files: OrderedDict[str, int] = OrderedDict()
+        self._filling: Dict[str, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(self.FILL_WORKERS)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        files = []
+
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".tmp"):
+                # Left over from an interrupted fill
+                with contextlib.suppress(OSError):
+                    os.remove(entry.path)
+            elif entry.name.endswith(".ogg"):
+                stat = entry.stat()
+                files.append((stat.st_atime, entry.name[:-len(".ogg")], stat.st_size))
+
+        for _, key, size in sorted(files):
+            self._files[key] = size
+            self.size += size
+
+        self._evict()
+
+    @staticmethod
+    def worker_path(path: str, index: int) -> str:
+        # Every process of a sharded bot has a directory (and a share of the budget) of its own,
+        # so none of them evicts what the others cached
+        return os.path.join(path, f"worker-{index}")
+
+    @classmethod
+    def prune_workers(cls, path: str, processes: int):
+        # Directories of workers that no longer exist, after running with fewer processes
+        with contextlib.suppress(OSError):
+            for entry in os.scandir(path):
+                name, _, index = entry.name.partition("-")
+
+                if entry.is_dir() and name == "worker" and index.isdigit() and int(index) >= processes:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha1(ExtractionCache.normalize_url(url).encode()).hexdigest()
+
+    def file_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.ogg")
+
+    def __contains__(self, url: str):
+        return self.key(url) in self._files
+
+    def lookup(self, url: str) -> Optional[str]:
+        key = self.key(url)
+
+        if key not in self._files:
+            self.misses += 1
+            return None
+
+        path = self.file_path(key)
+
+        # Keeps the LRU order across restarts, even on `noatime` mounts
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Deleted behind our back
+            self.size -= self._files.pop(key)
+            self.misses += 1
+            return None
+        except OSError:
+            pass
+
+        self.hits += 1
+        self._files.move_to_end(key)
+        return path
+
+    def fill(self, url: str, stream_url: str, duration: Optional[int]):
+        key = self.key(url)
+
+        if key in self._files or key in self._filling or (duration or 0) > self.MAX_DURATION:
+            return
+
+        task = self._filling[key] = asyncio.get_running_loop().create_task(self._fill(key, stream_url))
+        task.add_done_callback(lambda _: self._filling.pop(key, None))
+
+    async def _fill(self, key: str, stream_url: str):
+        async with self._semaphore:
+            path = self.file_path(key)
+            # Written next to the final file and renamed, so readers never see half a file
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-nostdin", "-loglevel", "error",
+                *YTDLSource.FFMPEG_OPTIONS["before_options"].split(),
+                "-i", stream_url, "-vn", "-c:a", "libopus", "-b:a", self.BITRATE, "-f", "ogg", "-y", temporary_path,
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            )
+
+            try:
+                _, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                raise
+            finally:
+                if process.returncode != 0:
+                    with contextlib.suppress(OSError):
+                        os.remove(temporary_path)
+
+            if process.returncode != 0:
+                print(f"Caching {key} failed: {stderr.decode(errors='replace').strip()}")
+                return
+
+            os.replace(temporary_path, path)
+            size = os.path.getsize(path)
+
+            self._files[key] = size
+            self.size += size
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._files:
+            key, size = self._files.popitem(last=False)
+            self.size -= size
+
+            # Songs still playing from it keep their open file
+            with contextlib.suppress(OSError):
+                os.remove(self.file_path(key))
+
+    def close(self):
+        for task in self._filling.values():
+            task.cancel()
+
+
+class LoudnessIndex:
+    # Per-track gain that brings everything to the same loudness (EBU R128). Measured once by FFmpeg in
+    # the background and applied by the FFmpeg playing it, along with the volume, so it costs nothing per frame.
+    # Only files in the `AudioCache` are measured, so it's off unless AUDIO_CACHE_PATH is set.
+    # An empty path disables it too.
+    PATH = os.getenv("LOUDNESS_DB_PATH", "loudness.sqlite3")
+    # Integrated loudness everything is brought to, in LUFS
+    TARGET = float(os.getenv("LOUDNESS_TARGET", "-16"))
+    # Quiet tracks aren't boosted beyond this, or past a true peak of MAX_PEAK dBFS
+    MAX_BOOST = 12
+    MAX_PEAK = -1
+    # Each analysis is an FFmpeg decoding the whole track as fast as it can
+    WORKERS = 1
+    # Analyses waiting for a worker, tracks beyond that are measured another time they're played
+    MAX_PENDING = 20
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS loudness (
+            key TEXT PRIMARY KEY,
+            integrated REAL NOT NULL,
+            peak REAL NOT NULL,
+            measured_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        self._db, self._executor = _open_database(path, self.SCHEMA, "loudness")
+
+        # `AudioCache.key` of the URL -> gain in dB
+        self._gains: Dict[str, float] = {
+            key: self.gain(integrated, peak)
+            for key, integrated, peak in self._db.execute("SELECT key, integrated, peak FROM loudness")
+        }
+        self._analysing: Dict[str, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(self.WORKERS)
+        self.analysed = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._gains)
+
+    @classmethod
+    def gain(cls, integrated: float, peak: float) -> float:
+        return min(cls.TARGET - integrated, cls.MAX_PEAK - peak, cls.MAX_BOOST)
+
+    def lookup(self, url: str) -> Optional[float]:
+        return self._gains.get(AudioCache.key(url))
+
+    def analyse(self, url: str, path: str):
+        # `path` is the cached file of the track, the result is only used the next time it's played
+        key = AudioCache.key(url)
+
+        if key in self._gains or key in self._analysing or len(self._analysing) >= self.MAX_PENDING:
+            return
+
+        task = self._analysing[key] = asyncio.get_running_loop().create_task(self._analyse(key, path))
+        task.add_done_callback(lambda _: self._analysing.pop(key, None))
+
+    async def _analyse(self, key: str, path: str):
+        loop = asyncio.get_running_loop()
+
+        async with self._semaphore:
+            # Another process of a sharded bot may have measured it already
+            measured = await loop.run_in_executor(self._executor, self._load, key)
+
+            if measured is None:
+                with metrics.time("loudness_analysis"):
+                    measured = await self.measure(path)
+
+                if measured is None:
+                    self.failed += 1
+                    return
+
+                await loop.run_in_executor(self._executor, self._save, key, *measured)
+                self.analysed += 1
+
+            self._gains[key] = self.gain(*measured)
+
+    @staticmethod
+    async def measure(path: str) -> Optional[tuple]:
+        # (integrated loudness in LUFS, true peak in dBFS)
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-nostdin", "-hide_banner", "-nostats", "-i", path,
+            # Per-frame measurements are only logged at the verbose level, the summary always is
+            "-vn", "-af", "ebur128=peak=true:framelog=verbose", "-f", "null", "-",
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+
+        output = stderr.decode(errors="replace")
+        summary = output.rsplit("Summary:", 1)[-1]
+        integrated = re.search(r"I:\s+(-?[\d.]+) LUFS", summary)
+        peak = re.search(r"Peak:\s+(-?[\d.]+|-inf) dBFS", summary)
+
+        if process.returncode != 0 or integrated is None or peak is None:
+            print(f"Measuring the loudness of {path} failed: {output.strip()[-500:]}")
+            return None
+
+        return float(integrated.group(1)), float(peak.group(1))
+
+    def _load(self, key: str) -> Optional[tuple]:
+        return self._db.execute("SELECT integrated, peak FROM loudness WHERE key = ?", (key,)).fetchone()
+
+    def _save(self, key: str, integrated: float, peak: float):
+        self._db.execute("INSERT OR REPLACE INTO loudness VALUES (?, ?, ?, ?)", (key, integrated, peak, time.time()))
+        self._db.commit()
+
+    def close(self):
+        for task in self._analysing.values():
+            task.cancel()
+
+        self._executor.shutdown(wait=False)
+
+
 class YTDLSource():
     YTDL_OPTIONS = {
         "format": "bestaudio/best",
@@ -74,14 +917,41 @@ class YTDLSource():
         "options": "-vn",
     }
 
-    ytdl = yt_dlp.YoutubeDL(YTDL_OPTIONS)
-
-    def __init__(self, ctx: discord.ApplicationContext, data: Dict):
-        self.requester = ctx.author
-        self.channel = ctx.channel
-
-        self.data = data
-        self.title = data.get("title")
+    # "opus" has FFmpeg produce Opus itself (or just remux it), "pcm" scales and encodes every frame in Python
+    PLAYBACK_MODE = os.getenv("PLAYBACK_MODE", "opus")
+    OPUS_BITRATE = 128
+
+    # Playlists are streamed into the queue in batches of this many songs
+    PLAYLIST_BATCH_SIZE = int(os.getenv("PLAYLIST_BATCH_SIZE", "50"))
+
+    # All shared between all guilds
+    engine = ExtractionEngine()
+    cache = ExtractionCache()
+    # Identical lookups running at the same time, e.g. a link pasted into a few guilds at once
+    inflight = SingleFlight()
+    # Set up by `MusicBot` if `AudioCache.PATH` is configured
+    audio_cache: AudioCache = None
+    # Likewise with `LoudnessIndex.PATH`
+    loudness: LoudnessIndex = None
+
+    # Queues can hold thousands of these, so they keep only what playback, `/queue` and
+    # `QueueStore` need instead of the info dict (see `benchmark.py` for the size of one)
+    __slots__ = (
+        "requester", "channel", "title", "url", "original_name", "stream_url", "stream_expires_at", "codec",
+        "duration_in_seconds", "time_elapsed_timer", "thumbnail", "_embed",
+    )
+
+    # Embed titles can't be longer anyway
+    MAX_TITLE_LENGTH = 256
+
+    def __init__(self, ctx: Optional[discord.ApplicationContext], data: Dict, requester=None, channel=None):
+        # Shared by every song of an import rather than copied, names of members that left are interned
+        requester = requester or ctx.author
+        self.requester = sys.intern(requester) if isinstance(requester, str) else requester
+        self.channel = channel or ctx.channel
+
+        title = data.get("title")
+        self.title = title[:self.MAX_TITLE_LENGTH] if title is not None else None
         self.url = data.get("webpage_url", data.get("url"))
         self.original_name = data.get("original_name")
 
@@ -89,279 +959,2880 @@ class YTDLSource():
         # self.duration = self.parse_duration(int(data.get("duration")))
         # self.thumbnail = data.get("thumbnail")
         self.stream_url = None
+        self.stream_expires_at = None
+        self.codec = None
         self.duration_in_seconds = None
         self.time_elapsed_timer = None
         self.thumbnail = None
 
-        self.player = None
+        # (what it depends on, embed dict) for `create_embed`
+        self._embed = None
 
     def __str__(self):
         return f"**{self.title}**"
 
     def has_full_source(self):
-        return self.stream_url is not None \
-           and self.duration_in_seconds is not None \
-           and self.thumbnail is not None
+        # Not every video has a thumbnail, so that doesn't count. Signed stream URLs expire though.
+        return self.stream_url is not None and self.duration_in_seconds is not None and self.stream_expires_in() > 0
 
     async def get_full_source(self, loop: asyncio.BaseEventLoop):
-        partial = functools.partial(self.ytdl.extract_info, self.url, download=False)
-        data = await loop.run_in_executor(None, partial)
+        key = f"stream:{self.cache.normalize_url(self.url)}"
+        info = self.cache.get(key)
+
+        if info is None:
+            info = await self.inflight.run(key, self._resolve_stream, loop, self.channel.guild.id, self.url)
+
+        # Get more data
+        self.stream_url, self.stream_expires_at, self.codec, self.duration_in_seconds, self.thumbnail = info
+
+    def stream_expires_in(self) -> float:
+        # Seconds the resolved stream URL can still be handed to FFmpeg
+        if self.stream_url is None:
+            return 0
+
+        return ExtractionCache.stream_ttl(self.stream_expires_at)
+
+    async def refresh_stream(self, loop: asyncio.BaseEventLoop):
+        # Resolved again ahead of time, bypassing the cache (which still has the expiring one).
+        # Keyed apart from `get_full_source`, which shouldn't end up waiting on a background job.
+        key = f"refresh:{self.cache.normalize_url(self.url)}"
+        info = await self.inflight.run(key, self._resolve_stream, loop, self.channel.guild.id, self.url, True)
+
+        self.stream_url, self.stream_expires_at, self.codec, self.duration_in_seconds, self.thumbnail = info
+
+    @classmethod
+    async def _resolve_stream(
+        cls, loop: asyncio.BaseEventLoop, guild_id: int, url: str, background: bool = False
+    ) -> tuple:
+        with metrics.time("stream_refresh" if background else "full_source"):
+            data = await cls.engine.extract_info(loop, guild_id, url, background=background)
 
         if data is None:
             # Video probably unavailable
-            raise YTDLError(f"Couldn't fetch data from {self.url}")
+            raise YTDLError(f"Couldn't fetch data from {url}")
 
-        # Get more data
-        self.stream_url = data.get("url")
-        self.duration_in_seconds = int(data.get("duration"))
-        self.thumbnail = data.get("thumbnail")
+        return cls.cache_stream_info(url, data)
+
+    @classmethod
+    def cache_stream_info(cls, url: str, data: Dict) -> tuple:
+        stream_url = data.get("url")
+        # Assumed to be good for the configured TTL if it doesn't say
+        expires_at = ExtractionCache.parse_stream_expiry(stream_url) or time.time() + ExtractionCache.STREAM_TTL
+        info = (stream_url, expires_at, data.get("acodec"), int(data.get("duration")), data.get("thumbnail"))
+
+        cls.cache.put(f"stream:{cls.cache.normalize_url(url)}", info, ExtractionCache.stream_ttl(expires_at))
+        return info
+
+    def is_cached(self) -> bool:
+        return self.audio_cache is not None and self.url in self.audio_cache
 
-    async def get_player(self, volume: float = 0.5, loop: asyncio.BaseEventLoop = None):
+    def cached_audio(self) -> Optional[str]:
+        return self.audio_cache.lookup(self.url) if self.audio_cache is not None else None
+
+    async def get_player(self, volume: float = 1.0, loop: asyncio.BaseEventLoop = None, start_at: float = 0):
         loop = loop or asyncio.get_event_loop()
-        if not self.has_full_source():
-            await self.get_full_source(loop)
+        cached = self.cached_audio()
+
+        if cached is not None:
+            # Local file, no stream URL needed (and nothing to reconnect to)
+            audio, options, codec = cached, {"before_options": "", "options": "-vn"}, "opus"
+
+            if self.duration_in_seconds is None:
+                import mutagen
+
+                self.duration_in_seconds = int(mutagen.File(cached).info.length)
+        else:
+            if not self.has_full_source():
+                await self.get_full_source(loop)
+
+            audio, options, codec = self.stream_url, dict(self.FFMPEG_OPTIONS), self.codec
+
+            if self.audio_cache is not None:
+                self.audio_cache.fill(self.url, self.stream_url, self.duration_in_seconds)
+
+        gain = self.loudness.lookup(self.url) if self.loudness is not None else None
 
-        self.time_elapsed_timer = Timer()
+        # Measured from the cached file once there is one, never by downloading the stream again
+        if gain is None and cached is not None and self.loudness is not None:
+            self.loudness.analyse(self.url, cached)
+
+        self.time_elapsed_timer = Timer(start_at)
+
+        if start_at > 0:
+            # Input seeking, so FFmpeg doesn't decode everything before that point
+            options["before_options"] = f"-ss {start_at:.2f} {options['before_options']}"
 
         try:
-            return discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(self.stream_url, **self.FFMPEG_OPTIONS), volume)
+            with metrics.time("ffmpeg_spawn"):
+                if self.PLAYBACK_MODE == "pcm":
+                    if gain:
+                        # The volume can change while playing, so only the gain is left to FFmpeg
+                        options["options"] = f"{options['options']} -af volume={gain:.2f}dB"
+
+                    return discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(audio, **options), volume)
+
+                # Gain and volume in one filter
+                scale = volume * 10 ** ((gain or 0) / 20)
+
+                if scale != 1:
+                    # Applied by FFmpeg, which has to re-encode then
+                    options["options"] = f"{options['options']} -af volume={scale:.3f}"
+                    codec = None
+
+                # An Opus input at full volume is only remuxed, without decoding it at all
+                return discord.FFmpegOpusAudio(audio, bitrate=self.OPUS_BITRATE, codec=codec, **options)
         except discord.ClientException:
-            raise YTDLError("FFmpegPCMAudio subprocess failed to be created. Is one already running?")
+            raise YTDLError("FFmpeg subprocess failed to be created. Is one already running?")
+
+    def to_record(self) -> Dict:
+        data = {"title": self.title, "webpage_url": self.url, "original_name": self.original_name}
+
+        return {
+            "data": {key: value for key, value in data.items() if value is not None},
+            "requester_id": getattr(self.requester, "id", None),
+            "requester": str(self.requester),
+            "channel_id": self.channel.id,
+            "stream_url": self.stream_url,
+            "stream_expires_at": self.stream_expires_at,
+            "codec": self.codec,
+            "duration": self.duration_in_seconds,
+            "thumbnail": self.thumbnail,
+        }
+
+    @classmethod
+    def from_record(cls, guild: discord.Guild, record: Dict, default_channel=None) -> "YTDLSource":
+        requester = guild.get_member(record["requester_id"] or 0) or record["requester"]
+        channel = guild.get_channel(record["channel_id"]) or default_channel
+        source = cls(None, record["data"], requester=requester, channel=channel)
+
+        # Only reuse the resolved stream if it's still good, otherwise it's re-extracted before playing
+        if record["stream_url"] is not None and record["stream_expires_at"] is not None \
+                and ExtractionCache.stream_ttl(record["stream_expires_at"]) > 0:
+            source.stream_url = record["stream_url"]
+            source.stream_expires_at = record["stream_expires_at"]
+            source.codec = record.get("codec")
+            source.duration_in_seconds = record["duration"]
+            source.thumbnail = record["thumbnail"]
+
+        return source
 
     @classmethod
     async def prepare_sources(cls, ctx: discord.ApplicationContext, target: str, loop: asyncio.BaseEventLoop = None):
+        return [source async for sources in cls.iter_sources(ctx, target, loop) for source in sources]
+
+    @classmethod
+    async def iter_sources(
+        cls, ctx: discord.ApplicationContext, target: str, loop: asyncio.BaseEventLoop = None
+    ) -> AsyncIterator[List["YTDLSource"]]:
         loop = loop or asyncio.get_event_loop()
+        found = False
 
         if cls.is_url(target):
-            videos = await cls.get_data_from_url(target, loop)
+            async for videos in cls.get_data_from_url(target, loop, ctx.guild.id):
+                found = True
+                yield [cls(ctx, video) for video in videos]
         else:
-            videos = await cls.get_data_from_name(target, loop)
+            videos = await cls.get_data_from_name(target, loop, ctx.guild.id)
 
-        if len(videos) == 0:
+            if len(videos) != 0:
+                found = True
+                yield [cls(ctx, video) for video in videos]
+
+        if not found:
             raise YTDLError(f"Cannot prefetch video(s) at {target}")
 
-        return list(map(lambda video: cls(ctx, video), videos))
+    @classmethod
+    async def get_data_from_name(cls, name: str, loop: asyncio.BaseEventLoop, guild_id: int = None) -> List[Dict]:
+        key = f"search:{cls.cache.normalize_query(name)}"
+        entry = cls.cache.get(key)
+
+        if entry is None:
+            entry = await cls.inflight.run(key, cls._search, key, loop, guild_id, name)
+
+            if entry is None:
+                return []
+
+        entry = dict(entry)
+        entry["original_name"] = name  # Save the original name too
+
+        return [entry]
+
+    @classmethod
+    async def _search(cls, key: str, loop: asyncio.BaseEventLoop, guild_id: int, name: str) -> Optional[Dict]:
+        # Still have to process here to get the actual url.
+        with metrics.time("search"):
+            data = await cls.engine.extract_info(loop, guild_id, f"ytsearch:{name}")
+
+        if not data or not data.get("entries"):
+            return None
+
+        entry = data["entries"][0]
+
+        # The search result is fully processed, so the stream is already resolved
+        if entry.get("url") and entry.get("duration") is not None:
+            cls.cache_stream_info(entry.get("webpage_url", entry["url"]), entry)
+
+        entry = ExtractionCache.trim(entry)
+        cls.cache.put(key, entry, ExtractionCache.METADATA_TTL)
+
+        return entry
+
+    @classmethod
+    async def get_data_from_url(
+        cls, url: str, loop: asyncio.BaseEventLoop, guild_id: int = None
+    ) -> AsyncIterator[List[Dict]]:
+        # Yields entries in batches, starting with a single one so playback can start right away
+        key = f"url:{cls.cache.normalize_url(url)}"
+        cached = cls.cache.get(key)
+
+        if cached is not None:
+            entries = SharedEntries(iter(cached), False)
+        else:
+            entries = await cls.inflight.run(key, cls._extract_entries, loop, guild_id, url)
+
+            if entries is None:
+                return
+
+        def fetch(iterator: Iterator[Dict], size: int, worker: int):
+            return cls.engine.run(loop, guild_id, _next_batch, iterator, size, worker=worker)
+
+        start = 0
+        batch_size = 1
+
+        while True:
+            batch = await entries.batch(start, batch_size, fetch)
+
+            if len(batch) == 0:
+                break
+
+            start += len(batch)
+            batch_size = cls.PLAYLIST_BATCH_SIZE
+
+            yield [dict(entry) for entry in batch]
+
+        # Only reached if the consumer took everything, partial imports aren't cached
+        if cached is None:
+            cls.cache.put(key, entries.fetched, ExtractionCache.METADATA_TTL)
+
+    @classmethod
+    async def _extract_entries(cls, loop: asyncio.BaseEventLoop, guild_id: int, url: str) -> Optional[SharedEntries]:
+        with metrics.time("url_extraction"):
+            data = await cls.engine.extract_info(loop, guild_id, url, process=False)
+
+        if not data:
+            return None
+
+        entries = data.get("entries")
+
+        if entries is None:
+            entries = [data]
+
+        return SharedEntries(iter(entries), not isinstance(entries, (list, tuple)), data.get("_worker"))
+
+    @staticmethod
+    def format_time(time_elapsed_in_seconds: int, duration_in_seconds: int) -> str:
+        time_elapsed_minutes, time_elapsed_seconds = divmod(time_elapsed_in_seconds, 60)
+        time_elapsed_hours, time_elapsed_minutes = divmod(time_elapsed_minutes, 60)
+
+        duration_minutes, duration_seconds = divmod(duration_in_seconds, 60)
+        duration_hours, duration_minutes = divmod(duration_minutes, 60)
+
+        time_elapsed_hours = int(time_elapsed_hours)
+        time_elapsed_minutes = str(int(time_elapsed_minutes)).zfill(2)
+        time_elapsed_seconds = str(int(time_elapsed_seconds)).zfill(2)
+
+        duration_hours = int(duration_hours)
+        duration_minutes = str(int(duration_minutes)).zfill(2)
+        duration_seconds = str(int(duration_seconds)).zfill(2)
+
+        if duration_hours == 0: 
+            time_elapsed = f"{time_elapsed_minutes}:{time_elapsed_seconds}"
+            duration = f"{duration_minutes}:{duration_seconds}"
+        else:
+            time_elapsed = f"{time_elapsed_hours}:{time_elapsed_minutes}:{time_elapsed_seconds}"
+            duration = f"{duration_hours}:{duration_minutes}:{duration_seconds}"
+            
+        return f"{time_elapsed}/{duration}"
+
+    @staticmethod
+    def is_url(string: str) -> bool:
+        result = urlparse(string)
+        return all([result.scheme, result.netloc])
+
+    @staticmethod
+    def parse_time(string: str) -> float:
+        # "90", "1:30" or "1:01:30", raises `ValueError` for anything else
+        parts = string.strip().split(":")
+
+        if not 1 <= len(parts) <= 3 or any(not part.strip().replace(".", "", 1).isdigit() for part in parts):
+            raise ValueError(f"{string!r} isn't a time")
+
+        seconds = 0.0
+
+        for part in parts:
+            seconds = seconds * 60 + float(part)
+
+        return seconds
+
+    def progress(self, position: float = None) -> Optional[str]:
+        # Songs played from the audio cache might not have been fully resolved
+        if self.duration_in_seconds is None or (position is None and self.time_elapsed_timer is None):
+            return None
+
+        if position is None:
+            position = self.time_elapsed_timer.get_time()
+
+        return self.format_time(position, self.duration_in_seconds)
+
+    def create_embed(self, position: float = None):
+        # Everything but the progress is put together once per song, the now playing message
+        # gets re-rendered every few seconds while it plays.
+        key = (self.thumbnail, self.duration_in_seconds)
+
+        if self._embed is None or self._embed[0] != key:
+            embed = discord.Embed(
+                title="Now playing",
+                description=f"```css\n{self.title}\n```",
+                color=discord.Color.blurple()
+            )
+
+            embed.add_field(name="Requested by", value=self.requester)
+
+            if self.thumbnail is not None:
+                embed.set_thumbnail(url=self.thumbnail)
+
+            # Make sure the URL is always the last embed, since it looks weird otherwise
+            embed.add_field(name="URL", value=f"[Click]({self.url})")
+
+            self._embed = (key, embed.to_dict())
+
+        data = dict(self._embed[1])
+        progress = self.progress(position)
+
+        if progress is not None:
+            data["fields"] = data["fields"][:1] + [{"name": "Duration", "value": progress, "inline": True}] \
+                + data["fields"][1:]
+
+        return discord.Embed.from_dict(data)
+
+
+class Song:
+    __slots__ = ("source", "requester", "store_id", "position")
+
+    def __init__(self, source: YTDLSource):
+        self.source = source
+        self.requester = source.requester
+
+        # Set by `QueueStore` once the song has been persisted
+        self.store_id: int = None
+        self.position: float = None
+
+    def __str__(self):
+        return str(self.source)
+
+
+class BlockList:
+    # Items are kept in blocks of about this size, with a Fenwick tree over the
+    # block lengths to find the block holding a position in O(log n).
+    LOAD = 64
+
+    def __init__(self, items=()):
+        items = list(items)
+
+        self._blocks: List[list] = [items[i:i + self.LOAD] for i in range(0, len(items), self.LOAD)]
+        self._len = len(items)
+        self._rebuild()
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._blocks)
+
+    def __repr__(self):
+        return f"BlockList({list(self)!r})"
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._slice(index)
+
+        block, offset = self._locate(self._normalize(index))
+        return self._blocks[block][offset]
+
+    def __setitem__(self, index: int, value):
+        block, offset = self._locate(self._normalize(index))
+        self._blocks[block][offset] = value
+
+    def __delitem__(self, index: int):
+        self.pop(index)
+
+    def append(self, item):
+        self.insert(self._len, item)
+
+    def insert(self, index: int, item):
+        # Same clamping as `list.insert`
+        if index < 0:
+            index = max(index + self._len, 0)
+
+        index = min(index, self._len)
+
+        if not self._blocks:
+            self._blocks.append([item])
+            self._len = 1
+            self._rebuild()
+            return
+
+        if index == self._len:
+            block, offset = len(self._blocks) - 1, len(self._blocks[-1])
+        else:
+            block, offset = self._locate(index)
+
+        self._blocks[block].insert(offset, item)
+        self._len += 1
+
+        if len(self._blocks[block]) > 2 * self.LOAD:
+            half = self._blocks[block][self.LOAD:]
+            del self._blocks[block][self.LOAD:]
+            self._blocks.insert(block + 1, half)
+            self._rebuild()
+        else:
+            self._update(block, 1)
+
+    def pop(self, index: int = -1):
+        block, offset = self._locate(self._normalize(index))
+        item = self._blocks[block].pop(offset)
+        self._len -= 1
+
+        if not self._blocks[block]:
+            del self._blocks[block]
+            self._rebuild()
+        else:
+            self._update(block, -1)
+
+        return item
+
+    def popleft(self):
+        if self._len == 0:
+            raise IndexError("pop from an empty BlockList")
+
+        return self.pop(0)
+
+    def clear(self):
+        self._blocks.clear()
+        self._len = 0
+        self._rebuild()
+
+    def _normalize(self, index: int) -> int:
+        if index < 0:
+            index += self._len
+
+        if not 0 <= index < self._len:
+            raise IndexError("BlockList index out of range")
+
+        return index
+
+    def _slice(self, index: slice) -> list:
+        start, stop, step = index.indices(self._len)
+
+        if step != 1:
+            return [self[i] for i in range(start, stop, step)]
+
+        if start >= stop:
+            return []
+
+        block, offset = self._locate(start)
+        result = []
+
+        while len(result) < stop - start:
+            result.extend(self._blocks[block][offset:offset + stop - start - len(result)])
+            block, offset = block + 1, 0
+
+        return result
+
+    def _rebuild(self):
+        # 1-based Fenwick tree, `_tree[i]` covers blocks `(i - (i & -i), i]`
+        self._tree = [0] + [len(block) for block in self._blocks]
+
+        for i in range(1, len(self._tree)):
+            parent = i + (i & -i)
+
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[i]
+
+    def _update(self, block: int, delta: int):
+        i = block + 1
+
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _locate(self, index: int) -> tuple:
+        # Finds the last block whose preceding blocks hold at most `index` items
+        position = 0
+        remaining = index
+        step = 1 << (len(self._tree) - 1).bit_length()
+
+        while step:
+            if position + step < len(self._tree) and self._tree[position + step] <= remaining:
+                position += step
+                remaining -= self._tree[position]
+
+            step >>= 1
+
+        return position, remaining
+
+
+class SongQueue(asyncio.Queue):
+    def __init__(self, *args, **kwargs):
+        # Callbacks of the form `listener(event, *args)`, run on every mutation
+        self._listeners = []
+        # Bumped on every clear, lets long-running imports notice they should stop
+        self.generation = 0
+        super().__init__(*args, **kwargs)
+
+    def _init(self, maxsize: int):
+        # Positional access, moves and removals are all O(log n) instead of O(n) on a deque
+        self._queue = BlockList()
+
+    def __getitem__(self, item):
+        return self._queue[item]
+
+    def __iter__(self):
+        return self._queue.__iter__()
+
+    def __len__(self):
+        return self.qsize()
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _notify(self, event: str, *args):
+        for listener in self._listeners:
+            listener(event, *args)
+
+    def _put(self, item):
+        super()._put(item)
+        self._notify("put", item)
+
+    def _get(self):
+        item = super()._get()
+        self._notify("get", item)
+        return item
+
+    def clear(self):
+        self._queue.clear()
+        self.generation += 1
+        self._notify("clear")
+
+    def shuffle(self):
+        items = list(self._queue)
+        random.shuffle(items)
+
+        self._queue = BlockList(items)
+        self._notify("shuffle")
+
+    def remove(self, index: int):
+        item = self._queue.pop(index)
+        self._notify("remove", item)
+
+    async def move(self, what: int, where: int):
+        # Done in place, since draining and refilling the queue would look like
+        # every song being removed and re-added to the listeners.
+        item = self._queue.pop(what)
+        self._queue.insert(where, item)
+        self._notify("move", item, where)
+
+
+class QueuePrefetcher:
+    # How many songs from the head of the queue to resolve ahead of time
+    DEPTH = int(os.getenv("PREFETCH_DEPTH", "2"))
+
+    def __init__(self, songs: SongQueue, loop: asyncio.AbstractEventLoop, depth: int = None):
+        self.songs = songs
+        self.loop = loop
+        self.depth = self.DEPTH if depth is None else depth
+
+        self._tasks: Dict[YTDLSource, asyncio.Task] = {}
+        # The song most recently taken from the queue, its prefetch is handed over to `wait_for`
+        self._handed_off: YTDLSource = None
+
+        songs.add_listener(self._on_queue_change)
+
+    def _on_queue_change(self, event: str, *args):
+        if event == "get":
+            self._handed_off = args[0].source
+
+        self.refresh()
+
+    def refresh(self):
+        window = {song.source for song in self.songs[:self.depth]}
+
+        # Drop work for songs that were removed, moved back or cleared
+        for source in list(self._tasks):
+            if source not in window and source is not self._handed_off:
+                self._tasks.pop(source).cancel()
+
+        for source in window:
+            if source not in self._tasks and not source.has_full_source() and not source.is_cached():
+                self._tasks[source] = self.loop.create_task(self._prefetch(source))
+
+    async def _prefetch(self, source: YTDLSource):
+        try:
+            await source.get_full_source(self.loop)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # `get_player` will try again (and report the failure) once it's this song's turn
+            print(f"Prefetching {source.url} failed: {e}")
+
+    async def wait_for(self, source: YTDLSource):
+        if source is self._handed_off:
+            self._handed_off = None
+
+        task = self._tasks.pop(source, None)
+
+        if task is not None:
+            # Not awaited directly, since the prefetch may have been cancelled or failed
+            await asyncio.wait([task])
+
+    def cancel_all(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+        self._tasks.clear()
+        self._handed_off = None
+
+
+class StreamRefresher:
+    # Re-resolves stream URLs about to expire near the head of every queue (and looping songs),
+    # in the background, so no song has to wait for it once it's its turn.
+    INTERVAL = 60
+    # Songs from the head of each queue to look at
+    DEPTH = int(os.getenv("STREAM_REFRESH_DEPTH", "10"))
+    # Refresh what expires within this many seconds
+    MARGIN = int(os.getenv("STREAM_REFRESH_MARGIN", "900"))
+    # Refreshed at once, every one as a background extraction job
+    BATCH_SIZE = 5
+
+    def __init__(self, voice_states: "VoiceStateRegistry"):
+        self.voice_states = voice_states
+        self.refreshed = 0
+        self.failed = 0
+
+    def expiring(self) -> List[YTDLSource]:
+        sources = []
+
+        for state in self.voice_states:
+            candidates = [song.source for song in state.songs[:self.DEPTH]]
+
+            if state.loop and state.current is not None:
+                candidates.insert(0, state.current)
+
+            # Never resolved ones are left to the prefetcher, they aren't expiring
+            sources.extend(
+                source for source in candidates
+                if source.stream_url is not None and source.stream_expires_in() < self.MARGIN
+                and not source.is_cached()
+            )
+
+        # Soonest to expire first, and the same source only once
+        return sorted(set(sources), key=lambda source: source.stream_expires_in())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.INTERVAL)
+            await self.refresh(self.expiring())
+
+    async def refresh(self, sources: List[YTDLSource]):
+        loop = asyncio.get_running_loop()
+
+        for start in range(0, len(sources), self.BATCH_SIZE):
+            batch = sources[start:start + self.BATCH_SIZE]
+            results = await asyncio.gather(*(source.refresh_stream(loop) for source in batch), return_exceptions=True)
+
+            for source, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    # Left as it is, `get_player` resolves it once more if it has to
+                    print(f"Refreshing the stream of {source.url} failed: {result}")
+                    self.failed += 1
+                else:
+                    self.refreshed += 1
+
+
+def _open_database(path: str, schema: str, name: str, *pragmas: str) -> Tuple[sqlite3.Connection, ThreadPoolExecutor]:
+    # sqlite connections shouldn't be shared between threads, so all queries go through the returned executor
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    for pragma in pragmas:
+        db.execute(f"PRAGMA {pragma}")
+    db.executescript(schema)
+    return db, executor
+
+
+class QueueStore:
+    # Set to an empty string to disable persistence
+    PATH = os.getenv("QUEUE_DB_PATH", "queues.sqlite3")
+    # Mutations are batched into one transaction per this many seconds
+    FLUSH_INTERVAL = 1.0
+    # How often the elapsed time of playing songs is saved
+    CHECKPOINT_INTERVAL = 10
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS queued (
+            guild_id INTEGER NOT NULL,
+            song_id INTEGER NOT NULL,
+            position REAL NOT NULL,
+            track TEXT NOT NULL,
+            PRIMARY KEY (guild_id, song_id)
+        );
+        CREATE INDEX IF NOT EXISTS queued_order ON queued (guild_id, position);
+        CREATE TABLE IF NOT EXISTS playing (
+            guild_id INTEGER PRIMARY KEY,
+            voice_channel_id INTEGER NOT NULL,
+            track TEXT NOT NULL,
+            elapsed REAL NOT NULL,
+            looping INTEGER NOT NULL
+        );
+        -- Kept apart from `playing`, which is empty between songs
+        CREATE TABLE IF NOT EXISTS voice_channels (
+            guild_id INTEGER PRIMARY KEY,
+            voice_channel_id INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        self._db, self._executor = _open_database(path, self.SCHEMA, "queue-store", "synchronous=NORMAL")
+
+        last_id = self._db.execute("SELECT MAX(song_id) FROM queued").fetchone()[0]
+        self._ids = itertools.count((last_id or 0) + 1)
+
+        self._pending: List[tuple] = []
+        self._flusher: asyncio.Task = None
+        # Guilds with a saved queue that wasn't restored (yet), it's replaced once they start a new one
+        self._unrestored = set()
+
+    def attach(self, guild_id: int, songs: SongQueue):
+        listener = functools.partial(self._on_queue_change, guild_id, songs)
+        songs.add_listener(listener)
+        return listener
+
+    def _on_queue_change(self, guild_id: int, songs: SongQueue, event: str, *args):
+        if event == "put":
+            song = args[0]
+
+            if guild_id in self._unrestored and song.store_id is None:
+                self._unrestored.discard(guild_id)
+                self._execute("DELETE FROM queued WHERE guild_id = ?", (guild_id,))
+                self.clear_playing(guild_id)
+
+            # Restored songs are already stored
+            if song.store_id is None:
+                previous = songs[-2] if len(songs) > 1 else None
+                song.store_id = next(self._ids)
+                song.position = previous.position + 1 if previous is not None else 0
+                self._execute(
+                    "INSERT OR REPLACE INTO queued VALUES (?, ?, ?, ?)",
+                    (guild_id, song.store_id, song.position, json.dumps(song.source.to_record())),
+                )
+        elif event in ("get", "remove"):
+            self._execute("DELETE FROM queued WHERE guild_id = ? AND song_id = ?", (guild_id, args[0].store_id))
+        elif event == "move":
+            song, index = args
+            before = songs[index - 1].position if index > 0 else None
+            after = songs[index + 1].position if index + 1 < len(songs) else None
+
+            if before is None and after is None:
+                song.position = 0
+            elif before is None:
+                song.position = after - 1
+            elif after is None:
+                song.position = before + 1
+            else:
+                song.position = (before + after) / 2
+
+            if song.position in (before, after):
+                # Ran out of float precision between the neighbours
+                self._renumber(guild_id, songs)
+            else:
+                self._execute(
+                    "UPDATE queued SET position = ? WHERE guild_id = ? AND song_id = ?",
+                    (song.position, guild_id, song.store_id),
+                )
+        elif event == "clear":
+            self._execute("DELETE FROM queued WHERE guild_id = ?", (guild_id,))
+        elif event == "shuffle":
+            self._renumber(guild_id, songs)
+
+    def _renumber(self, guild_id: int, songs: SongQueue):
+        for position, song in enumerate(songs):
+            song.position = position
+
+        self._execute(
+            "UPDATE queued SET position = ? WHERE guild_id = ? AND song_id = ?",
+            [(song.position, guild_id, song.store_id) for song in songs],
+            many=True,
+        )
+
+    def set_playing(self, guild_id: int, voice_channel_id: int, source: YTDLSource, elapsed: float, looping: bool):
+        self.set_voice_channel(guild_id, voice_channel_id)
+        self._execute(
+            "INSERT OR REPLACE INTO playing VALUES (?, ?, ?, ?, ?)",
+            (guild_id, voice_channel_id, json.dumps(source.to_record()), elapsed, looping),
+        )
+
+    def update_elapsed(self, guild_id: int, elapsed: float, looping: bool):
+        self._execute("UPDATE playing SET elapsed = ?, looping = ? WHERE guild_id = ?", (elapsed, looping, guild_id))
+
+    def clear_playing(self, guild_id: int):
+        self._execute("DELETE FROM playing WHERE guild_id = ?", (guild_id,))
+
+    def set_voice_channel(self, guild_id: int, voice_channel_id: int):
+        self._execute("INSERT OR REPLACE INTO voice_channels VALUES (?, ?)", (guild_id, voice_channel_id))
+
+    def restored(self, guild_id: int):
+        self._unrestored.discard(guild_id)
+
+    async def load(self) -> Dict[int, Dict]:
+        def load():
+            saved = {}
+
+            for guild_id, voice_channel_id, track, elapsed, looping in self._db.execute("SELECT * FROM playing"):
+                saved[guild_id] = {
+                    "voice_channel_id": voice_channel_id,
+                    "playing": json.loads(track),
+                    "elapsed": elapsed,
+                    "looping": bool(looping),
+                    "queued": [],
+                }
+
+            voice_channels = dict(self._db.execute("SELECT guild_id, voice_channel_id FROM voice_channels"))
+            rows = self._db.execute("SELECT guild_id, song_id, position, track FROM queued ORDER BY guild_id, position")
+
+            for guild_id, song_id, position, track in rows:
+                # Restarted between two songs
+                saved.setdefault(
+                    guild_id,
+                    {"voice_channel_id": voice_channels.get(guild_id), "playing": None, "looping": False, "queued": []},
+                )
+                saved[guild_id]["queued"].append((song_id, position, json.loads(track)))
+
+            return saved
+
+        saved = await asyncio.get_running_loop().run_in_executor(self._executor, load)
+        self._unrestored = set(saved)
+        return saved
+
+    def _execute(self, query: str, params, many: bool = False):
+        self._pending.append((query, params, many))
+
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+        finally:
+            # Also runs when cancelled on shutdown, so the last changes aren't lost
+            pending, self._pending = self._pending, []
+
+            if pending:
+                await asyncio.shield(asyncio.get_running_loop().run_in_executor(self._executor, self._commit, pending))
+
+    def _commit(self, pending: List[tuple]):
+        with self._db:
+            for query, params, many in pending:
+                if many:
+                    self._db.executemany(query, params)
+                else:
+                    self._db.execute(query, params)
+
+
+class HistoryIndex:
+    # Tracks played in one guild, searchable by prefixes of the words in their titles and the names they were found by
+    def __init__(self):
+        # url -> [title, original name, plays, last played]
+        self.tracks: Dict[str, list] = {}
+        # word -> urls of the tracks it appears in
+        self._words: Dict[str, set] = {}
+        # The same words, sorted, so the ones with a prefix are next to each other
+        self._sorted: List[str] = []
+        # Normalized title or original name -> url, for recognizing a query without searching
+        self._names: Dict[str, str] = {}
+
+    def __len__(self):
+        return len(self.tracks)
+
+    @staticmethod
+    def words(*texts: Optional[str]) -> set:
+        return {word for text in texts if text for word in re.findall(r"\w+", text.lower())}
+
+    def add(self, url: str, title: str, original_name: Optional[str], plays: int, last_played: float):
+        if url in self.tracks:
+            self.remove(url)
+
+        self.tracks[url] = [title, original_name, plays, last_played]
+
+        for word in self.words(title, original_name):
+            if word not in self._words:
+                self._words[word] = set()
+                bisect.insort(self._sorted, word)
+
+            self._words[word].add(url)
+
+        for name in (title, original_name):
+            if name:
+                self._names[ExtractionCache.normalize_query(name)] = url
+
+    def remove(self, url: str):
+        title, original_name, _, _ = self.tracks.pop(url)
+
+        for word in self.words(title, original_name):
+            urls = self._words[word]
+            urls.discard(url)
+
+            if not urls:
+                del self._words[word]
+                del self._sorted[bisect.bisect_left(self._sorted, word)]
+
+        for name in (title, original_name):
+            if name and self._names.get(ExtractionCache.normalize_query(name)) == url:
+                del self._names[ExtractionCache.normalize_query(name)]
+
+    def least_played(self) -> str:
+        return min(self.tracks, key=lambda url: self.tracks[url][2:])
+
+    def resolve(self, query: str) -> Optional[str]:
+        query = query.strip()
+
+        if query in self.tracks:
+            return query
+
+        return self._names.get(ExtractionCache.normalize_query(query))
+
+    def search(self, query: str, limit: int) -> List[str]:
+        # Tracks with words starting with every word of the query, most played first
+        matches = None
+
+        for prefix in self.words(query):
+            urls = set()
+
+            for word in itertools.islice(self._sorted, bisect.bisect_left(self._sorted, prefix), None):
+                if not word.startswith(prefix):
+                    break
+
+                urls |= self._words[word]
+
+            matches = urls if matches is None else matches & urls
+
+            if not matches:
+                return []
+
+        candidates = self.tracks if matches is None else matches
+        return sorted(candidates, key=lambda url: self.tracks[url][2:], reverse=True)[:limit]
+
+
+class TrackHistory:
+    # Tracks each guild played before, for `/play` autocomplete and so picking one (or asking for one by the
+    # same name again) doesn't need a search. Loaded per guild the first time it's needed, an empty path disables it.
+    PATH = os.getenv("HISTORY_DB_PATH", "history.sqlite3")
+    # Per guild, the least played ones are forgotten first
+    MAX_TRACKS = int(os.getenv("HISTORY_MAX_TRACKS", "2000"))
+    # Most Discord shows, and the longest a choice can be
+    MAX_SUGGESTIONS = 25
+    MAX_CHOICE_LENGTH = 100
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS history (
+            guild_id INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            title TEXT NOT NULL,
+            original_name TEXT,
+            plays INTEGER NOT NULL,
+            last_played REAL NOT NULL,
+            PRIMARY KEY (guild_id, url)
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        self._db, self._executor = _open_database(path, self.SCHEMA, "history")
+
+        self._indexes: Dict[int, HistoryIndex] = {}
+        self._loading = SingleFlight()
+
+    async def index(self, guild_id: int) -> HistoryIndex:
+        index = self._indexes.get(guild_id)
+
+        if index is None:
+            index = await self._loading.run(str(guild_id), self._load, guild_id)
+
+        return index
+
+    async def _load(self, guild_id: int) -> HistoryIndex:
+        rows = await asyncio.get_running_loop().run_in_executor(
+            self._executor,
+            lambda: self._db.execute(
+                "SELECT url, title, original_name, plays, last_played FROM history WHERE guild_id = ?", (guild_id,)
+            ).fetchall(),
+        )
+
+        index = self._indexes[guild_id] = HistoryIndex()
+
+        for row in rows:
+            index.add(*row)
+
+        return index
+
+    async def suggest(self, guild_id: int, query: str) -> List[discord.OptionChoice]:
+        index = await self.index(guild_id)
+        choices = []
+
+        for url in index.search(query, self.MAX_SUGGESTIONS):
+            # Longer URLs can't be the value of a choice, the title is searched for then
+            value = url if len(url) <= self.MAX_CHOICE_LENGTH else index.tracks[url][0][:self.MAX_CHOICE_LENGTH]
+            choices.append(discord.OptionChoice(index.tracks[url][0][:self.MAX_CHOICE_LENGTH], value))
+
+        return choices
+
+    async def resolve(self, guild_id: int, query: str) -> Optional[Dict]:
+        # The data of a known track the query is the URL or name of
+        index = await self.index(guild_id)
+        url = index.resolve(query)
+
+        if url is None:
+            return None
+
+        title, original_name, _, _ = index.tracks[url]
+        return {"title": title, "webpage_url": url, "original_name": original_name}
+
+    async def record(self, guild_id: int, source: YTDLSource):
+        if source.title is None or source.url is None:
+            return
+
+        index = await self.index(guild_id)
+        known = index.tracks.get(source.url)
+        # Keeps the name it was first found by, when it's played again from a suggestion
+        original_name = source.original_name or (known[1] if known is not None else None)
+        plays = known[2] + 1 if known is not None else 1
+        index.add(source.url, source.title, original_name, plays, time.time())
+        forgotten = []
+
+        while len(index) > self.MAX_TRACKS:
+            forgotten.append(index.least_played())
+            index.remove(forgotten[-1])
+
+        await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._save, guild_id, source.url, source.title, original_name, plays, forgotten
+        )
+
+    def _save(self, guild_id: int, url: str, title: str, original_name: str, plays: int, forgotten: List[str]):
+        self._db.execute(
+            "INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?)",
+            (guild_id, url, title, original_name, plays, time.time()),
+        )
+        self._db.executemany(
+            "DELETE FROM history WHERE guild_id = ? AND url = ?", [(guild_id, url) for url in forgotten]
+        )
+        self._db.commit()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class LyricsService:
+    SEARCH_URL = "https://api.genius.com/search"
+    # Lyrics barely ever change, misses are retried sooner in case Genius adds them
+    TTL = 24 * 60 * 60
+    NEGATIVE_TTL = 60 * 60
+    CACHE_SIZE = int(os.getenv("LYRICS_CACHE_SIZE", "512"))
+    # Per request, in seconds
+    TIMEOUT = 10
+    CONNECTIONS = 8
+
+    # The maximum message length allowed by discord
+    MAX_MESSAGE_LENGTH = 2000
+
+    # Noise in video titles that only makes the search worse
+    TITLE_NOISE = re.compile(r"[(\[][^)\]]*(official|video|audio|lyric|visuali[sz]er|hd|4k|remaster)[^)\]]*[)\]]", re.I)
+
+    def __init__(self, token: str):
+        self.token = token
+
+        # Values are lists of message chunks, or empty tuples for songs without lyrics
+        self.cache = ExtractionCache(self.CACHE_SIZE)
+        self._session: aiohttp.ClientSession = None
+        self._inflight = SingleFlight()
+        # Prefetches still running, referenced until they're done
+        self._prefetching = set()
+
+    async def search(self, name: str) -> Optional[List[str]]:
+        query = self.normalize(name)
+        key = f"lyrics:{query}"
+        chunks = self.cache.get(key)
+
+        if chunks is not None:
+            return chunks or None
+
+        # The prefetch and a `/lyrics` might ask for the same song at once
+        return await self._inflight.run(key, self._search, key, query)
+
+    async def for_song(self, source: YTDLSource) -> Optional[List[str]]:
+        chunks = None
+
+        if source.original_name is not None:
+            chunks = await self.search(source.original_name)
+
+        if chunks is None:
+            chunks = await self.search(source.title)
+
+        return chunks
+
+    def prefetch(self, source: YTDLSource):
+        async def prefetch():
+            try:
+                await self.for_song(source)
+            except Exception as e:
+                print(f"Prefetching lyrics for {source.title} failed: {e}")
+
+        task = asyncio.get_running_loop().create_task(prefetch())
+        self._prefetching.add(task)
+        task.add_done_callback(self._prefetching.discard)
+
+    async def close(self):
+        for task in self._prefetching:
+            task.cancel()
+
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _search(self, key: str, query: str) -> Optional[List[str]]:
+        session = self._get_session()
+
+        async with session.get(self.SEARCH_URL, params={"q": query}) as response:
+            response.raise_for_status()
+            hits = (await response.json())["response"]["hits"]
+
+        song = next((hit["result"] for hit in hits if hit.get("type") == "song"), None)
+        lyrics = None
+
+        if song is not None:
+            async with session.get(song["url"]) as response:
+                response.raise_for_status()
+                page = await response.text()
+
+            # Parsing a whole page takes long enough to be worth getting off the event loop
+            lyrics = await asyncio.get_running_loop().run_in_executor(None, self.parse_lyrics, page)
+
+        if lyrics is None:
+            self.cache.put(key, (), self.NEGATIVE_TTL)
+            return None
+
+        chunks = self.split_message(lyrics)
+        self.cache.put(key, chunks, self.TTL)
+        return chunks
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={"Authorization": f"Bearer {self.token}"},
+                timeout=aiohttp.ClientTimeout(total=self.TIMEOUT),
+                connector=aiohttp.TCPConnector(limit=self.CONNECTIONS),
+            )
+
+        return self._session
+
+    @classmethod
+    def normalize(cls, name: str) -> str:
+        return " ".join(cls.TITLE_NOISE.sub(" ", name).lower().split())
+
+    @staticmethod
+    def parse_lyrics(page: str) -> Optional[str]:
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(page, "html.parser")
+
+        for header in soup.find_all("div", class_=re.compile("LyricsHeader")):
+            header.decompose()
+
+        containers = soup.find_all("div", attrs={"data-lyrics-container": "true"})
+
+        if not containers:
+            return None
+
+        for br in soup.find_all("br"):
+            br.replace_with("\n")
+
+        lyrics = "\n".join(container.get_text() for container in containers).strip()
+        return lyrics or None
+
+    @classmethod
+    def split_message(cls, message: str) -> List[str]:
+        # Split the lyrics into chunks of max_length characters
+        chunks = []
+
+        while len(message) > cls.MAX_MESSAGE_LENGTH:
+            # Find the last newline before the max_length limit
+            split_index = message.rfind('\n', 0, cls.MAX_MESSAGE_LENGTH)
+
+            if split_index == -1:  # No newline found, split at max_length
+                split_index = cls.MAX_MESSAGE_LENGTH
+
+            chunks.append(message[:split_index])
+            message = message[split_index:]
+
+        chunks.append(message)
+        return chunks
+
+
+class BufferedSource(discord.AudioSource):
+    def __init__(self, source: discord.AudioSource):
+        self.source = source
+        self._buffer = deque()
+
+    def prime(self, frames: int):
+        # Blocking, as FFmpeg first has to start, connect and probe, so run it in an executor
+        with metrics.time("first_packet"):
+            data = self.source.read()
+
+        for _ in range(frames):
+            if not data:
+                break
+
+            self._buffer.append(data)
+            data = self.source.read()
+
+    def read(self) -> bytes:
+        return self._buffer.popleft() if self._buffer else self.source.read()
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self._buffer.clear()
+        self.source.cleanup()
+
+
+class TrackChain(discord.AudioSource):
+    # Stays on the voice client across songs, switching to the next one as soon as the
+    # current one runs out, without waiting for `after` and the event loop.
+    FRAME_LENGTH = discord.opus.Encoder.FRAME_LENGTH / 1000
+
+    def __init__(self, source: discord.AudioSource, on_transition, frame: int = 0, expected_frames: int = 0):
+        self.current = source
+        # Frames into the current song
+        self.frame = frame
+        # Running dry before this frame means the stream broke, so the next song isn't switched to
+        self.expected_frames = expected_frames
+        # Set until the first frame of a freshly started source has been read
+        self._started_at = time.perf_counter()
+
+        # Only guards swapping sources around, reads happen outside of it so the
+        # event loop never waits on FFmpeg.
+        self._lock = threading.Lock()
+        self._next: discord.AudioSource = None
+        self._next_token = None
+        self._fade_from: int = None
+        self._fade_frames = 1
+        self._skip = False
+        # Sources dropped from the loop's side, cleaned up on the audio thread since it might be reading them
+        self._discarded: List[discord.AudioSource] = []
+        # Called on the audio thread with the token of the song that just started
+        self._on_transition = on_transition
+
+    @property
+    def next_token(self):
+        return self._next_token
+
+    @property
+    def position(self) -> float:
+        # Seconds into the current song, by what was actually sent out
+        return self.frame * self.FRAME_LENGTH
+
+    @property
+    def broken(self) -> bool:
+        # Whether the current song stopped before it should have
+        return self.frame < self.expected_frames
+
+    def queue_next(self, source: discord.AudioSource, token, fade_from: int = None, fade_frames: int = 1):
+        # `fade_from` is the frame of the current song to start crossfading into the next one at
+        with self._lock:
+            if self._next is not None:
+                self._discarded.append(self._next)
+
+            self._next, self._next_token = source, token
+            self._fade_from, self._fade_frames = fade_from, fade_frames
+
+    def withdraw(self):
+        with self._lock:
+            if self._next is not None:
+                self._discarded.append(self._next)
+
+            self._next, self._next_token, self._fade_from, self._skip = None, None, None, False
+
+    def replace_current(self, source: discord.AudioSource, frame: int):
+        with self._lock:
+            self._discarded.append(self.current)
+            self.current, self.frame = source, frame
+            self._started_at = time.perf_counter()
+
+    def skip(self) -> bool:
+        with self._lock:
+            self._skip = self._next is not None
+            # Cut short on purpose
+            self.expected_frames = 0
+            return self._skip
+
+    def read(self) -> bytes:
+        self._cleanup_discarded()
+
+        with self._lock:
+            current, incoming, fade_from = self.current, self._next, self._fade_from
+            skipping, self.frame = self._skip, self.frame + 1
+            progress = self.frame - fade_from if fade_from is not None else 0
+
+        data = b"" if skipping else current.read()
+
+        if data and incoming is not None and progress > 0:
+            data = self._crossfade(data, incoming.read(), progress)
+
+        if data:
+            if self._started_at is not None:
+                metrics.observe("first_packet", time.perf_counter() - self._started_at)
+                self._started_at = None
+
+            return data
+
+        ended_at = time.perf_counter()
+
+        with self._lock:
+            if current is not self.current:
+                # Replaced while we were reading the old one
+                return self.current.read()
+
+            # The frame counted for this read didn't have anything in it
+            self.frame -= 1
+
+            if self._next is None or self.broken:
+                # Nothing lined up (or the song has to be resumed), the player stops and `after` takes over
+                return b""
+
+            self._discarded.append(self.current)
+            # Frames of it already mixed in by the crossfade have been played too
+            mixed = max(self.frame - self._fade_from, 0) if self._fade_from is not None else 0
+            # `expected_frames` is set for the new song once the event loop hears about it
+            self.current, self.frame, self.expected_frames = self._next, mixed + 1, 0
+            token = self._next_token
+            self._next, self._next_token, self._fade_from, self._skip = None, None, None, False
+
+        self._on_transition(token)
+
+        # Part of it might have been mixed in already
+        data = self.current.read()
+        metrics.observe("transition", time.perf_counter() - ended_at)
+        return data
+
+    def _crossfade(self, data: bytes, incoming: bytes, progress: int) -> bytes:
+        if not incoming:
+            return data
+
+        length = max(len(data), len(incoming))
+        data, incoming = data.ljust(length, b"\0"), incoming.ljust(length, b"\0")
+
+        # Linear fade over the frames left before the current song ends
+        mix = min(progress / self._fade_frames, 1)
+        return audioop.add(audioop.mul(data, 2, 1 - mix), audioop.mul(incoming, 2, mix), 2)
+
+    def _cleanup_discarded(self):
+        if self._discarded:
+            with self._lock:
+                discarded, self._discarded = self._discarded, []
+
+            for source in discarded:
+                source.cleanup()
+
+    def is_opus(self) -> bool:
+        return self.current.is_opus()
+
+    def cleanup(self):
+        self.withdraw()
+        self._cleanup_discarded()
+        self.current.cleanup()
+
+
+class Outbox:
+    # Outbound channel messages, sent by priority within Discord's rate limits. Callers wait
+    # until theirs went out, and for room in the queue first, so bulk content can't pile up.
+    # Interaction responses don't go through here (they have to be quick and have their own
+    # routes), but bulk sends hold back so those never find the global limit used up.
+
+    # Lower goes first
+    URGENT, NORMAL, BULK = 0, 1, 2
+
+    # Requests per second over all routes, Discord allows 50
+    GLOBAL_RATE = int(os.getenv("OUTBOX_GLOBAL_RATE", "40"))
+    # Part of `GLOBAL_RATE` only non-bulk messages may use, and likewise of every route
+    RESERVED = 10
+    ROUTE_RESERVED = 1
+    # Messages per channel in `ROUTE_PERIOD` seconds
+    ROUTE_LIMIT = 5
+    ROUTE_PERIOD = 5.0
+    MAX_PENDING = int(os.getenv("OUTBOX_MAX_PENDING", "200"))
+
+    # Embed limits
+    DESCRIPTION_LENGTH = 4096
+    MESSAGE_LENGTH = 6000
+    MAX_EMBEDS = 10
+
+    def __init__(self):
+        self._queues = [deque(), deque(), deque()]
+        self._slots = asyncio.Semaphore(self.MAX_PENDING)
+        # Send times within the last second, and within `ROUTE_PERIOD` per route
+        self._sent = deque()
+        self._routes: Dict[Any, deque] = {}
+        # Routes with a message on its way, one at a time keeps them in order
+        self._busy = set()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task = None
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues)
+
+    async def send(self, destination: discord.abc.Messageable, priority: int = NORMAL, **kwargs) -> discord.Message:
+        async with self._slots:
+            future = asyncio.get_running_loop().create_future()
+            item = (destination, kwargs, future)
+            self._queues[priority].append(item)
+            self._wakeup.set()
+
+            if self._task is None or self._task.done():
+                self._task = asyncio.get_running_loop().create_task(self._run())
+
+            try:
+                return await future
+            except asyncio.CancelledError:
+                with contextlib.suppress(ValueError):
+                    self._queues[priority].remove(item)
+
+                raise
+
+    async def send_chunks(
+        self,
+        destination: discord.abc.Messageable,
+        chunks: List[str],
+        title: str = None,
+        priority: int = BULK,
+    ) -> List[discord.Message]:
+        # Packed into as few messages as possible, in order
+        return [
+            await self.send(destination, priority, embeds=embeds)
+            for embeds in self.pack("".join(chunks), title)
+        ]
+
+    @classmethod
+    def pack(cls, text: str, title: str = None) -> List[List[discord.Embed]]:
+        messages, embeds, used = [], [], 0
+
+        while text:
+            # Only the first embed gets the title
+            title_length = len(title) if title is not None and not messages and not embeds else 0
+            room = min(cls.DESCRIPTION_LENGTH, cls.MESSAGE_LENGTH - used - title_length)
+
+            # Not worth starting another embed for that little, continue in the next message
+            if len(embeds) == cls.MAX_EMBEDS or (room < len(text) and room < cls.DESCRIPTION_LENGTH // 4):
+                messages.append(embeds)
+                embeds, used = [], 0
+                continue
+
+            piece, text = cls._cut(text, room)
+            embed = discord.Embed(description=piece, color=discord.Color.blurple())
+
+            if title_length:
+                embed.title = title
+
+            embeds.append(embed)
+            used += len(piece) + title_length
+
+        if embeds:
+            messages.append(embeds)
+
+        return messages
+
+    @staticmethod
+    def _cut(text: str, length: int) -> tuple:
+        if len(text) <= length:
+            return text, ""
+
+        # At the last newline that fits, if there's one
+        index = text.rfind("\n", 0, length)
+
+        if index <= 0:
+            index = length
+
+        return text[:index], text[index:].lstrip("\n")
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+        for queue in self._queues:
+            for _, _, future in queue:
+                future.cancel()
+
+            queue.clear()
+
+    @staticmethod
+    def _route(destination: discord.abc.Messageable) -> Any:
+        # Channels and contexts are both keyed by their channel
+        channel = getattr(destination, "channel", None) or destination
+        return getattr(channel, "id", id(channel))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        while len(self) > 0:
+            now = time.monotonic()
+
+            while self._sent and now - self._sent[0] >= 1:
+                self._sent.popleft()
+
+            for route in [route for route, sent in self._routes.items() if now - sent[-1] >= self.ROUTE_PERIOD]:
+                del self._routes[route]
+
+            item = self._next(now)
+
+            if item is not None:
+                priority, index, route = item
+                destination, kwargs, future = self._queues[priority][index]
+                del self._queues[priority][index]
+
+                if future.done():
+                    # The caller gave up on it
+                    continue
+
+                self._sent.append(now)
+                self._routes.setdefault(route, deque(maxlen=self.ROUTE_LIMIT)).append(now)
+                self._busy.add(route)
+                loop.create_task(self._deliver(route, destination, kwargs, future))
+                continue
+
+            # Nothing can go out right now, wait for a slot to free up or something new
+            self._wakeup.clear()
+
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), 0.1)
+
+    def _next(self, now: float) -> Optional[tuple]:
+        for priority, queue in enumerate(self._queues):
+            bulk = priority == self.BULK
+
+            if len(self._sent) >= self.GLOBAL_RATE - (self.RESERVED if bulk else 0):
+                continue
+
+            route_limit = self.ROUTE_LIMIT - (self.ROUTE_RESERVED if bulk else 0)
+
+            for index, (destination, _, _) in enumerate(queue):
+                route = self._route(destination)
+
+                if route in self._busy:
+                    continue
+
+                if sum(1 for sent in self._routes.get(route, ()) if now - sent < self.ROUTE_PERIOD) >= route_limit:
+                    continue
+
+                return priority, index, route
+
+        return None
+
+    async def _deliver(self, route: Any, destination: discord.abc.Messageable, kwargs: Dict, future: asyncio.Future):
+        try:
+            message = await destination.send(**kwargs)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(message)
+        finally:
+            self._busy.discard(route)
+            self._wakeup.set()
+
+
+class NowPlayingBoard:
+    # Keeps one "Now playing" message per guild, edited in place while the song plays.
+    # Edits of all guilds go through a single scheduler, which coalesces them and keeps
+    # within Discord's rate limits (about 5 edits per 5 seconds in a channel).
+
+    # Seconds between progress updates of a message
+    INTERVAL = float(os.getenv("NOW_PLAYING_INTERVAL", "15"))
+    # Over all guilds, leaving room under the global limit for everything else
+    EDITS_PER_SECOND = float(os.getenv("NOW_PLAYING_EDITS_PER_SECOND", "5"))
+    CHANNEL_INTERVAL = 1.0
+
+    def __init__(self, outbox: Outbox = None):
+        self.outbox = outbox
+        self._states: Dict[int, "VoiceState"] = {}
+        self._messages: Dict[int, discord.Message] = {}
+        # guild_id -> when its message should be updated next
+        self._due: Dict[int, float] = {}
+        # guild_id -> (source, progress) last shown, so nothing is sent if that hasn't changed
+        self._shown: Dict[int, tuple] = {}
+        # channel_id -> when it was last edited
+        self._channel_edits: Dict[int, float] = {}
+        self._updating = set()
+        self._tokens = self.EDITS_PER_SECOND
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task = None
+
+    def __len__(self):
+        return len(self._messages)
+
+    def track_started(self, state: "VoiceState"):
+        self._states[state.guild_id] = state
+        self.refresh(state.guild_id)
+
+    def refresh(self, guild_id: int):
+        # Called any number of times, it all ends up in at most one edit
+        if guild_id in self._states:
+            self._due[guild_id] = 0
+            self._wakeup.set()
+            self._ensure_running()
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def move(self, state: "VoiceState", channel: discord.abc.Messageable) -> discord.Message:
+        # Posts it anew at the bottom of `channel`, for `/np`
+        self._states[state.guild_id] = state
+        old = self._messages.pop(state.guild_id, None)
+        self._shown.pop(state.guild_id, None)
+
+        message = self._messages[state.guild_id] = await self._send(channel, state.current.create_embed(state.position))
+        self._shown[state.guild_id] = (state.current, state.current.progress(state.position))
+        self._due[state.guild_id] = time.monotonic() + self.INTERVAL
+
+        if old is not None:
+            with contextlib.suppress(discord.HTTPException):
+                await old.delete()
+
+        return message
+
+    async def _send(self, channel: discord.abc.Messageable, embed: discord.Embed) -> discord.Message:
+        if self.outbox is not None:
+            return await self.outbox.send(channel, Outbox.NORMAL, embed=embed)
+
+        return await channel.send(embed=embed)
+
+    def forget(self, guild_id: int):
+        # The message stays, it just isn't updated anymore
+        self._states.pop(guild_id, None)
+        self._messages.pop(guild_id, None)
+        self._due.pop(guild_id, None)
+        self._shown.pop(guild_id, None)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        last = time.monotonic()
+
+        while self._due:
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - last) * self.EDITS_PER_SECOND, self.EDITS_PER_SECOND)
+            last = now
+
+            # Most overdue first, songs that just started are due at 0
+            for guild_id in sorted(self._due, key=self._due.get):
+                if self._due[guild_id] > now or self._tokens < 1:
+                    break
+
+                if guild_id in self._updating or not self._may_edit(guild_id, now):
+                    continue
+
+                del self._due[guild_id]
+                self._tokens -= 1
+                self._updating.add(guild_id)
+                asyncio.get_running_loop().create_task(self._update(guild_id))
+
+            self._wakeup.clear()
+
+            # Until the next one is due, or something new comes up
+            next_due = min(self._due.values(), default=now + self.INTERVAL)
+            delay = min(max(next_due - now, 1 / self.EDITS_PER_SECOND), self.INTERVAL)
+
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+
+    def _may_edit(self, guild_id: int, now: float) -> bool:
+        message = self._messages.get(guild_id)
+
+        if message is None:
+            return True
+
+        return now - self._channel_edits.get(message.channel.id, 0) >= self.CHANNEL_INTERVAL
+
+    async def _update(self, guild_id: int):
+        try:
+            state = self._states.get(guild_id)
+            source = state.current if state is not None else None
+
+            if source is None:
+                return
+
+            if state.voice is None or not (state.voice.is_playing() or state.voice.is_paused()):
+                # Between songs, the next one brings it up to date
+                return
+
+            if guild_id in self._states:
+                self._due[guild_id] = time.monotonic() + self.INTERVAL
+                self._ensure_running()
+
+            position = state.position
+            shown = (source, source.progress(position))
+
+            if self._shown.get(guild_id) == shown:
+                # Paused, or nothing new to show yet
+                return
+
+            message = self._messages.get(guild_id)
+            embed = source.create_embed(position)
+
+            if message is not None and message.channel.id == source.channel.id:
+                self._channel_edits[message.channel.id] = time.monotonic()
+                await message.edit(embed=embed)
+            else:
+                # The first song, or it was requested from another channel
+                self._messages[guild_id] = await self._send(source.channel, embed)
+                self._channel_edits[source.channel.id] = time.monotonic()
+
+                if message is not None:
+                    with contextlib.suppress(discord.HTTPException):
+                        await message.delete()
+
+            if guild_id in self._states:
+                self._shown[guild_id] = shown
+        except discord.NotFound:
+            # Somebody deleted it, post a new one
+            self._messages.pop(guild_id, None)
+            self._shown.pop(guild_id, None)
+            self.refresh(guild_id)
+        except discord.HTTPException as e:
+            print(f"Couldn't update the now playing message of guild {guild_id}: {e}")
+        finally:
+            self._updating.discard(guild_id)
+
+
+class VoiceError(Exception):
+    pass
+
+
+class VoiceState:
+    # Start the next song's FFmpeg this many seconds before the current one ends
+    GAPLESS_LEAD = float(os.getenv("GAPLESS_LEAD", "10"))
+    GAPLESS_BUFFER_FRAMES = 25
+    # Seconds of crossfade between songs, only possible in the PCM playback mode
+    CROSSFADE = float(os.getenv("CROSSFADE", "0"))
+    CROSSFADE_FRAMES = max(int(CROSSFADE / TrackChain.FRAME_LENGTH), 1)
+    # A song ending more than this many seconds early broke off, and is resumed where it stopped
+    RESUME_TOLERANCE = 5
+    # Resumes per song, in case the stream keeps breaking
+    MAX_RESUMES = 3
+
+    def __init__(
+        self,
+        bot: commands.Bot,
+        guild_id: int,
+        ctx: discord.ApplicationContext = None,
+        store: QueueStore = None,
+        lyrics: LyricsService = None,
+        now_playing: NowPlayingBoard = None,
+    ):
+        self.bot = bot
+        self.guild_id = guild_id
+        self.ctx = ctx
+        self.store = store
+        self.lyrics = lyrics
+        self.now_playing = now_playing
+
+        self.songs: SongQueue = SongQueue()
+        self.prefetcher = QueuePrefetcher(self.songs, bot.loop)
+        # Offset to start the next song at, used when resuming after a restart
+        self.resume_position = 0
+
+        self._store_listener = store.attach(guild_id, self.songs) if store is not None else None
+        self.songs.add_listener(self._on_queue_change)
+
+        self.current: YTDLSource = None
+        self.voice: discord.VoiceClient = None
+
+        # What's on the voice client while playing, and the task getting its next song ready
+        self.chain: TrackChain = None
+        self._gapless: asyncio.Task = None
+        # When the last song ended through `after`, for measuring the gap until the next one
+        self._ended_at: float = None
+
+        self._loop = False
+        # Full volume by default, so Opus streams can be passed through without re-encoding
+        self._volume = 1.0
+
+        # Used by `VoiceStateRegistry` to find idle states to evict
+        self.last_active = time.monotonic()
+
+        self.audio_player = bot.loop.create_task(self.audio_player_task())
+
+    def __del__(self):
+        self.audio_player.cancel()
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    @property
+    def is_idle(self):
+        if self.voice and (self.voice.is_playing() or self.voice.is_paused()):
+            return False
+
+        return len(self.songs) == 0
+
+    @property
+    def loop(self):
+        return self._loop
+
+    @loop.setter
+    def loop(self, value: bool):
+        self._loop = value
+
+        if value:
+            # The current song plays again instead of whatever was lined up
+            self._withdraw_next()
+
+    @property
+    def is_playing(self):
+        return self.voice and self.current
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @property
+    def position(self) -> float:
+        # Seconds into the current song, counted in frames played while there's a chain
+        if self.chain is not None:
+            return self.chain.position
+
+        if self.current is not None and self.current.time_elapsed_timer is not None:
+            return self.current.time_elapsed_timer.get_time()
+
+        return 0
+
+    async def set_volume(self, volume: float):
+        self._volume = volume
+
+        if not self.voice or self.current is None or self.chain is None:
+            return
+
+        # Was made with the old volume
+        self._withdraw_next()
+
+        player = self.chain.current
+
+        if isinstance(player, BufferedSource):
+            player = player.source
+
+        if isinstance(player, discord.PCMVolumeTransformer):
+            player.volume = volume
+        else:
+            # FFmpeg applies the volume itself, so it has to be restarted from where it is
+            await self.restart_current()
+
+    async def restart_current(self, position: float = None):
+        # From `position`, or where it is now. Reuses the resolved stream (or cached file),
+        # `get_player` only extracts again if there's none.
+        paused = self.voice.is_paused()
+
+        if position is None:
+            position = self.position
+
+        player = await self.current.get_player(self._volume, start_at=position)
+
+        # Swapped within the chain, so the song doesn't count as finished
+        self.chain.replace_current(player, int(position / TrackChain.FRAME_LENGTH))
+
+        if paused:
+            self.current.time_elapsed_timer.pause()
+
+    async def seek(self, position: float) -> float:
+        if not self.voice or self.current is None or self.chain is None:
+            raise VoiceError("Nothing is playing right now.")
+
+        duration = self.current.duration_in_seconds
+
+        if duration is not None:
+            position = min(position, duration - 1)
+
+        position = max(position, 0)
+
+        # The lined up song would be crossfaded into at the wrong point
+        if self.chain.next_token is not None and self.CROSSFADE > 0:
+            self._withdraw_next()
+
+        await self.restart_current(position)
+
+        if self.now_playing is not None:
+            self.now_playing.refresh(self.guild_id)
+
+        return position
+
+    def _expected_frames(self) -> int:
+        duration = self.current.duration_in_seconds if self.current is not None else None
+
+        if duration is None:
+            return 0
+
+        return int((duration - self.RESUME_TOLERANCE) / TrackChain.FRAME_LENGTH)
+
+    async def audio_player_task(self):
+        # Times the current song was resumed after its stream broke off
+        resumes = 0
+        resuming = False
+
+        try:
+            while True:
+                self.touch()
+
+                if resuming:
+                    # The current song again, from where its stream broke off
+                    resuming = False
+                elif not self.loop:
+                    try:
+                        # Wait for three minutes (180 seconds) while inactive
+                        # before leaving the channel for performance reasons.
+                        async with timeout(180):
+                            song = await self.songs.get()
+                            self.current = song.source
+                    except asyncio.TimeoutError:
+                        # Finishing the task marks this state as dead, so the registry
+                        # evicts it and the next command starts with a fresh one.
+                        print("Leaving voice channel due to inactivity...")
+                        self.current = None
+                        await self.stop()
+                        return
+
+                # Resolved by `play_next_song` on the event loop once the song ends, with the player's error if any
+                finished = self.bot.loop.create_future()
+
+                if self.current is not None:
+                    playing = False
+
+                    try:
+                        start_at, self.resume_position = self.resume_position, 0
+
+                        # Usually resolved by the time the song reaches the head of the queue
+                        await self.prefetcher.wait_for(self.current)
+                        current_player = await self.current.get_player(self._volume, start_at=start_at)
+
+                        self.chain = TrackChain(
+                            current_player,
+                            self._on_transition_threadsafe,
+                            int(start_at / TrackChain.FRAME_LENGTH),
+                            self._expected_frames(),
+                        )
+                        self.voice.play(self.chain, after=functools.partial(self.play_next_song, finished))
+                        playing = True
+                        self._gapless = self.bot.loop.create_task(self.gapless_task(self.chain))
+
+                        if self._ended_at is not None:
+                            metrics.observe("transition", time.perf_counter() - self._ended_at)
+
+                        await self.song_started(start_at)
+                    except Exception as e:
+                        # TODO: Better video unavailable handling (catching a lot of possible exceptions here)
+                        print(e)
+                        self._ended_at = None
+
+                        # Unless it got as far as playing, then it ends through `after` like any other song
+                        if not playing and not finished.done():
+                            finished.set_result(None)
+
+                # Woken up by `play_next_song` on the event loop, never from the audio thread
+                error = await finished
+
+                if error is not None:
+                    print(f"The player of guild {self.guild_id} failed: {error}")
+
+                # Only counts as a transition if the next song was already waiting
+                if len(self.songs) == 0 and not self.loop:
+                    self._ended_at = None
+
+                # Only reached once the chain runs dry, songs handed over within it don't stop the player
+                if self._gapless is not None:
+                    self._gapless.cancel()
+                    self._gapless = None
+
+                chain, self.chain = self.chain, None
+
+                if self.bot.is_closed():
+                    # Shutting down, leave the queue as it is so it can be restored
+                    return
+
+                if chain is not None and chain.broken and self.voice is not None and resumes < self.MAX_RESUMES:
+                    # FFmpeg lost the stream, start it again from the last frame that got out
+                    print(f"{self.current.url} broke off at {chain.position:.1f}s, resuming")
+                    resumes += 1
+                    resuming = True
+                    self.resume_position = chain.position
+                    self._ended_at = None
+                    continue
+
+                resumes = 0
+
+                if self.store is not None:
+                    self.store.clear_playing(self.guild_id)
+        except Exception as e:
+            print(e)
+
+    async def song_started(self, start_at: float = 0):
+        if self.store is not None:
+            self.store.set_playing(self.guild_id, self.voice.channel.id, self.current, start_at, self.loop)
+
+        if self.lyrics is not None:
+            # So `/lyrics` for the current song is instant
+            self.lyrics.prefetch(self.current)
+
+        if self.now_playing is not None:
+            self.now_playing.track_started(self)
+        else:
+            await self.current.channel.send(embed=self.current.create_embed())
+
+    async def gapless_task(self, chain: TrackChain):
+        loop = asyncio.get_running_loop()
+        # Songs that failed to get ready, the regular path deals with them once it's their turn
+        failed = set()
+
+        while True:
+            await asyncio.sleep(1)
+
+            if chain.next_token is not None or self.loop or len(self.songs) == 0:
+                continue
+
+            current = self.current
+            duration = current.duration_in_seconds if current is not None else None
+
+            if duration is None or duration - self.position > self.GAPLESS_LEAD:
+                continue
+
+            song = self.songs[0]
+
+            if song in failed:
+                continue
+
+            try:
+                await self.prefetcher.wait_for(song.source)
+                player = BufferedSource(await song.source.get_player(self._volume))
+                await loop.run_in_executor(None, player.prime, self.GAPLESS_BUFFER_FRAMES)
+            except Exception as e:
+                print(f"Couldn't get {song.source.url} ready ahead of time: {e}")
+                failed.add(song)
+                continue
+
+            # The queue might have changed in the meantime
+            if chain is not self.chain or self.loop or len(self.songs) == 0 or self.songs[0] is not song:
+                player.cleanup()
+                continue
+
+            fade_from = None
+
+            if self.CROSSFADE > 0 and not player.is_opus():
+                fade_from = int(duration / TrackChain.FRAME_LENGTH) - self.CROSSFADE_FRAMES
+
+            chain.queue_next(player, song, fade_from, self.CROSSFADE_FRAMES)
+
+    def _on_transition_threadsafe(self, song: Song):
+        # Runs on the voice client's audio thread
+        self.bot.loop.call_soon_threadsafe(self._on_transition, song)
+
+    def _on_transition(self, song: Song):
+        if len(self.songs) > 0 and self.songs[0] is song:
+            self.songs.get_nowait()
+        else:
+            # Moved away after the chain already switched to it
+            for index, queued in enumerate(self.songs):
+                if queued is song:
+                    self.songs.remove(index)
+                    break
+
+        if self.store is not None:
+            self.store.clear_playing(self.guild_id)
+
+        self.current = song.source
+        self.current.time_elapsed_timer = Timer()
+        self.touch()
+
+        if self.chain is not None:
+            self.chain.expected_frames = self._expected_frames()
+        self.bot.loop.create_task(self.song_started())
+
+    def _on_queue_change(self, event: str, *args):
+        if self.chain is None or self.chain.next_token is None:
+            return
+
+        if len(self.songs) == 0 or self.songs[0] is not self.chain.next_token:
+            self._withdraw_next()
+
+    def _withdraw_next(self):
+        if self.chain is not None:
+            self.chain.withdraw()
+
+    def play_next_song(self, finished: asyncio.Future, error: Exception = None):
+        # The `after` callback of the voice client, which runs on its audio thread.
+        # Everything else happens on the event loop, woken up right away.
+        ended_at = time.perf_counter()
+
+        try:
+            self.bot.loop.call_soon_threadsafe(self._song_ended, finished, error, ended_at)
+        except RuntimeError:
+            # The loop is already closed, nobody's waiting anymore
+            pass
+
+    def _song_ended(self, finished: asyncio.Future, error: Optional[Exception], ended_at: float):
+        # Time it took the audio thread's news to reach the event loop
+        metrics.observe("handoff", time.perf_counter() - ended_at)
+
+        # Might be from a song that was already given up on
+        if not finished.done():
+            self._ended_at = ended_at
+            finished.set_result(error)
+
+    def skip(self):
+        if self.is_playing:
+            # Straight into the next song if it's ready, otherwise through `after`
+            if self.chain is None or not self.chain.skip():
+                self.voice.stop()
+
+    async def stop(self):
+        self.songs.clear()
+
+        if self.chain is not None:
+            # Not broken off, just stopped
+            self.chain.expected_frames = 0
+
+        if self.store is not None:
+            self.store.clear_playing(self.guild_id)
+
+        if self.now_playing is not None:
+            self.now_playing.forget(self.guild_id)
+
+        if self.voice:
+            # Disconnecting also stops the player, which kills its FFmpeg process
+            await self.voice.disconnect()
+            self.voice = None
+
+    async def close(self):
+        self.audio_player.cancel()
+        self.prefetcher.cancel_all()
+        await self.stop()
+
+    async def restore(self, guild: discord.Guild, saved: Dict):
+        voice_channel = guild.get_channel(saved["voice_channel_id"] or 0)
+
+        if voice_channel is None:
+            raise VoiceError("The voice channel is gone")
+
+        self.voice = await voice_channel.connect()
+        self.loop = saved.get("looping", False)
+        queued = saved["queued"]
+
+        if self.store is not None:
+            self.store.set_voice_channel(self.guild_id, voice_channel.id)
+
+        if saved["playing"] is not None:
+            song = Song(YTDLSource.from_record(guild, saved["playing"], voice_channel))
+            # Not in the `queued` table, it's picked up again as soon as it starts playing
+            song.store_id = -1
+            song.position = queued[0][1] - 1 if queued else 0
+            self.resume_position = saved["elapsed"]
+            self.songs.put_nowait(song)
+
+        for song_id, position, record in queued:
+            song = Song(YTDLSource.from_record(guild, record, voice_channel))
+            song.store_id = song_id
+            song.position = position
+            self.songs.put_nowait(song)
+
+        if self.store is not None:
+            self.store.restored(self.guild_id)
+
+    def detach_store(self):
+        # Closing the state afterwards leaves what's saved alone
+        if self._store_listener is not None:
+            self.songs.remove_listener(self._store_listener)
+            self._store_listener = None
+
+        self.store = None
+
+
+class VoiceStateRegistry:
+    # Seconds a voice state may stay idle before it gets evicted
+    IDLE_TIMEOUT = int(os.getenv("VOICE_STATE_IDLE_TIMEOUT", "300"))
+    # Upper bound on concurrently live voice states (one per guild)
+    MAX_STATES = int(os.getenv("MAX_VOICE_STATES", "500"))
+    SWEEP_INTERVAL = 60
+
+    def __init__(
+        self,
+        bot: commands.Bot,
+        store: QueueStore = None,
+        lyrics: LyricsService = None,
+        now_playing: NowPlayingBoard = None,
+    ):
+        self.bot = bot
+        self.store = store
+        self.lyrics = lyrics
+        self.now_playing = now_playing
+
+        # Ordered from least to most recently used
+        self._states: OrderedDict[int, VoiceState] = OrderedDict()
+        self._sweeper: asyncio.Task = None
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, guild_id: int):
+        return guild_id in self._states
+
+    def __iter__(self):
+        return iter(list(self._states.values()))
+
+    def get(self, ctx: discord.ApplicationContext) -> VoiceState:
+        return self.get_or_create(ctx.guild.id, ctx)
+
+    def get_or_create(self, guild_id: int, ctx: discord.ApplicationContext = None) -> VoiceState:
+        state = self._states.get(guild_id)
+
+        if state is not None and state.audio_player.done():
+            # The player task has finished (e.g. after leaving due to inactivity)
+            self._discard(guild_id)
+            state = None
+
+        if state is None:
+            if len(self._states) >= self.MAX_STATES and not self._evict_lru():
+                raise commands.CommandError("I'm playing in too many servers right now, try again later!")
+
+            state = VoiceState(self.bot, guild_id, ctx, self.store, self.lyrics, self.now_playing)
+            self._states[guild_id] = state
+
+        self._states.move_to_end(guild_id)
+        state.touch()
+
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = self.bot.loop.create_task(self._sweep())
+
+        return state
+
+    async def evict(self, guild_id: int):
+        state = self._states.pop(guild_id, None)
+
+        if state is not None:
+            await state.close()
+
+    def close_all(self):
+        for guild_id in list(self._states):
+            self._discard(guild_id)
+
+    def _discard(self, guild_id: int):
+        state = self._states.pop(guild_id, None)
+
+        if state is not None:
+            self.bot.loop.create_task(state.close())
+
+    def _evict_lru(self) -> bool:
+        for guild_id, state in self._states.items():
+            if state.audio_player.done() or state.is_idle:
+                self._discard(guild_id)
+                return True
+
+        return False
+
+    async def _sweep(self):
+        while self._states:
+            await asyncio.sleep(self.SWEEP_INTERVAL)
+            now = time.monotonic()
+
+            for guild_id, state in list(self._states.items()):
+                if state.audio_player.done() or (state.is_idle and now - state.last_active > self.IDLE_TIMEOUT):
+                    print(f"Evicting idle voice state of guild {guild_id}...")
+                    await self.evict(guild_id)
+
+
+class CommandSyncCache:
+    # Remembers what was last registered with Discord, so restarts with unchanged
+    # commands don't have to go through the API. An empty path always syncs.
+    PATH = os.getenv("COMMAND_CACHE_PATH", ".commands.json")
+    # Sync for real once in a while anyway, in case commands were changed from elsewhere
+    MAX_AGE = int(os.getenv("COMMAND_CACHE_MAX_AGE", str(24 * 60 * 60)))
+
+    def __init__(self, path: str):
+        self.path = path
+        # `on_connect` fires for every shard
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def digest(bot: commands.Bot) -> str:
+        payload = sorted((command.to_dict() for command in bot.pending_application_commands), key=lambda c: c["name"])
+        return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
 
-    @classmethod
-    async def get_data_from_name(cls, name: str, loop: asyncio.BaseEventLoop) -> List[Dict]:
-        # Still have to process here to get the actual url.
-        partial = functools.partial(cls.ytdl.extract_info, f"ytsearch:{name}", download=False)
-        data = await loop.run_in_executor(None, partial)
+    def load(self) -> Optional[Dict]:
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, saved: Dict):
+        # Written to a temporary file first, a half-written cache would be worse than none.
+        # Named after the process, the processes of a sharded bot share the cache.
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+
+        with open(temporary_path, "w") as file:
+            json.dump(saved, file)
+
+        os.replace(temporary_path, self.path)
+
+    async def sync(self, bot: commands.Bot, force: bool = False) -> bool:
+        # Returns whether it actually had to talk to Discord
+        async with self._lock:
+            return await self._sync(bot, force)
+
+    async def _sync(self, bot: commands.Bot, force: bool) -> bool:
+        digest = self.digest(bot)
+        saved = None if force or not self.path else self.load()
+
+        if (
+            saved is not None
+            and saved.get("digest") == digest
+            and saved.get("application_id") == bot.application_id
+            and time.time() - saved.get("synced_at", 0) < self.MAX_AGE
+            and self._restore_ids(bot, saved["ids"])
+        ):
+            return False
+
+        with metrics.time("command_sync"):
+            await bot.sync_commands()
+
+        if self.path:
+            ids = {command.name: command.id for command in bot.pending_application_commands if command.id is not None}
+            saved = {"digest": digest, "application_id": bot.application_id, "synced_at": time.time(), "ids": ids}
+
+            try:
+                self.save(saved)
+            except OSError as e:
+                print(f"Couldn't save the command cache: {e}")
 
-        if "entries" not in data or len(data["entries"]) == 0:
-            return [None]
+        return True
 
-        entry = data["entries"][0]
-        entry["original_name"] = name  # Save the original name too
+    @staticmethod
+    def _restore_ids(bot: commands.Bot, ids: Dict[str, str]) -> bool:
+        # Interactions are matched to commands by their IDs, which is what syncing would otherwise fill in
+        if any(command.name not in ids for command in bot.pending_application_commands):
+            return False
 
-        return [entry]
+        for command in bot.pending_application_commands:
+            command.id = ids[command.name]
+            bot._application_commands[command.id] = command
 
-    @classmethod
-    async def get_data_from_url(cls, url: str, loop: asyncio.BaseEventLoop) -> List[Dict]:
-        partial = functools.partial(cls.ytdl.extract_info, url, download=False, process=False)
-        data = await loop.run_in_executor(None, partial)
+        return True
 
-        if data.get("entries") is not None:
-            return list(data.get("entries"))
 
-        return [data]
-    
-    @staticmethod
-    def format_time(time_elapsed_in_seconds: int, duration_in_seconds: int) -> str:
-        time_elapsed_minutes, time_elapsed_seconds = divmod(time_elapsed_in_seconds, 60)
-        time_elapsed_hours, time_elapsed_minutes = divmod(time_elapsed_minutes, 60)
+class Coordinator:
+    # Lets the processes of a sharded bot ask each other things, like their stats for `/stats`.
+    # Runs in the launcher, workers connect to it over localhost and every request is fanned out to all of them.
+    # Messages are JSON, one per line.
+    HOST = "127.0.0.1"
+    # Seconds to wait for the answers of all workers
+    TIMEOUT = 5
+    # Longest message, in bytes
+    LIMIT = 1024 ** 2
+
+    def __init__(self, token: str):
+        # Shared with the workers, so nothing else on the machine can connect
+        self.token = token
+        self.port: int = None
+
+        self._server: asyncio.AbstractServer = None
+        # worker index -> its connection
+        self._workers: Dict[int, asyncio.StreamWriter] = {}
+        # call id -> (worker index, future of its answer)
+        self._calls: Dict[int, tuple] = {}
+        self._ids = itertools.count()
+        # Requests being fanned out, referenced until they're done
+        self._tasks = set()
 
-        duration_minutes, duration_seconds = divmod(duration_in_seconds, 60)
-        duration_hours, duration_minutes = divmod(duration_minutes, 60)
+    def __len__(self):
+        return len(self._workers)
 
-        time_elapsed_hours = int(time_elapsed_hours)
-        time_elapsed_minutes = str(int(time_elapsed_minutes)).zfill(2)
-        time_elapsed_seconds = str(int(time_elapsed_seconds)).zfill(2)
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.HOST, 0, limit=self.LIMIT)
+        self.port = self._server.sockets[0].getsockname()[1]
 
-        duration_hours = int(duration_hours)
-        duration_minutes = str(int(duration_minutes)).zfill(2)
-        duration_seconds = str(int(duration_seconds)).zfill(2)
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
 
-        if duration_hours == 0: 
-            time_elapsed = f"{time_elapsed_minutes}:{time_elapsed_seconds}"
-            duration = f"{duration_minutes}:{duration_seconds}"
-        else:
-            time_elapsed = f"{time_elapsed_hours}:{time_elapsed_minutes}:{time_elapsed_seconds}"
-            duration = f"{duration_hours}:{duration_minutes}:{duration_seconds}"
-            
-        return f"{time_elapsed}/{duration}"
+        for task in self._tasks:
+            task.cancel()
 
     @staticmethod
-    def is_url(string: str) -> bool:
-        result = urlparse(string)
-        return all([result.scheme, result.netloc])
+    def _send(writer: asyncio.StreamWriter, message: Dict):
+        writer.write(json.dumps(message).encode() + b"\n")
 
-    def create_embed(self):
-        embed = discord.Embed(
-            title="Now playing",
-            description=f"```css\n{self.title}\n```",
-            color=discord.Color.blurple()
-        )
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        index = None
 
-        embed.add_field(name="Requested by", value=self.requester)
+        try:
+            hello = json.loads(await reader.readline())
 
-        if self.has_full_source():
-            embed.add_field(name="Duration", value=f"{self.format_time(self.time_elapsed_timer.get_time(), self.duration_in_seconds)}")
-            embed.set_thumbnail(url=self.thumbnail)
+            if not hmac.compare_digest(str(hello.get("token")), self.token):
+                return
 
-        # Make sure the URL is always the last embed, since it looks weird otherwise
-        embed.add_field(name="URL", value=f"[Click]({self.url})")
+            index = hello["worker"]
+            self._workers[index] = writer
 
-        return embed
+            async for line in reader:
+                message = json.loads(line)
 
+                if "request" in message:
+                    # Answered by this worker too, so it mustn't hold up reading
+                    task = asyncio.create_task(self._fan_out(writer, message))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                elif "answer" in message:
+                    _, future = self._calls.pop(message["answer"], (None, None))
 
-class Song:
-    __slots__ = ("source", "requester")
+                    if future is not None and not future.done():
+                        future.set_result(message)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Coordination with worker {index} failed: {e}")
+        finally:
+            if index is not None and self._workers.get(index) is writer:
+                del self._workers[index]
 
-    def __init__(self, source: YTDLSource):
-        self.source = source
-        self.requester = source.requester
+                for call_id, (worker, future) in list(self._calls.items()):
+                    if worker == index:
+                        del self._calls[call_id]
 
-    def __str__(self):
-        return str(self.source)
+                        if not future.done():
+                            future.set_result({"error": "disconnected"})
 
+            writer.close()
 
-class SongQueue(asyncio.Queue):
-    def __getitem__(self, item):
-        if isinstance(item, slice):
-            return list(itertools.islice(self._queue, item.start, item.stop, item.step))
-        else:
-            return self._queue[item]
+    async def _fan_out(self, writer: asyncio.StreamWriter, request: Dict):
+        loop = asyncio.get_running_loop()
+        futures = {}
 
-    def __iter__(self):
-        return self._queue.__iter__()
+        for index, worker in sorted(self._workers.items()):
+            call_id = next(self._ids)
+            futures[index] = loop.create_future()
+            self._calls[call_id] = (index, futures[index])
+            self._send(worker, {"call": call_id, "op": request["op"], "args": request.get("args", {})})
 
-    def __len__(self):
-        return self.qsize()
+        if futures:
+            await asyncio.wait(futures.values(), timeout=self.TIMEOUT)
 
-    def clear(self):
-        self._queue.clear()
+        results = []
 
-    def shuffle(self):
-        random.shuffle(self._queue)
+        for index, future in futures.items():
+            if future.done():
+                answer = future.result()
+                results.append({"worker": index, **{key: answer[key] for key in ("result", "error") if key in answer}})
+            else:
+                future.cancel()
+                results.append({"worker": index, "error": "timed out"})
+
+        # Calls that timed out, late answers are dropped
+        for call_id in [call_id for call_id, (_, future) in self._calls.items() if future.cancelled()]:
+            del self._calls[call_id]
+
+        with contextlib.suppress(ConnectionError):
+            self._send(writer, {"reply": request["request"], "results": results})
+            await writer.drain()
+
+
+class CoordinatorClient:
+    # A worker's end of the `Coordinator`
+    def __init__(self, port: int, token: str, worker: int):
+        self.port = port
+        self.token = token
+        self.worker = worker
+
+        # op -> coroutine function answering it, called with the arguments of the request
+        self._handlers: Dict[str, Any] = {}
+        # request id -> future of the answers
+        self._requests: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count()
+        self._writer: asyncio.StreamWriter = None
+        self._reader_task: asyncio.Task = None
+        # Calls being answered, referenced until they're done
+        self._tasks = set()
+
+    def handle(self, op: str, handler):
+        self._handlers[op] = handler
+
+    async def connect(self):
+        reader, self._writer = await asyncio.open_connection(Coordinator.HOST, self.port, limit=Coordinator.LIMIT)
+        Coordinator._send(self._writer, {"worker": self.worker, "token": self.token})
+        await self._writer.drain()
+        self._reader_task = asyncio.create_task(self._read(reader))
+
+    async def request(self, op: str, **args) -> List[Dict]:
+        # Answers of every worker, this one included, as {"worker": index, "result" or "error": ...}
+        if self._writer is None or self._writer.is_closing():
+            raise ConnectionError("Not connected to the other processes.")
+
+        request_id = next(self._ids)
+        future = self._requests[request_id] = asyncio.get_running_loop().create_future()
 
-    def remove(self, index: int):
-        del self._queue[index]
+        try:
+            Coordinator._send(self._writer, {"request": request_id, "op": op, "args": args})
+            await self._writer.drain()
 
-    # Don't ask...
-    async def move(self, what: int, where: int):
-        items = []
+            async with timeout(Coordinator.TIMEOUT * 2):
+                return await future
+        finally:
+            self._requests.pop(request_id, None)
 
-        while not self.empty():
-            items.append(await self.get())
-            self.task_done()
+    async def _read(self, reader: asyncio.StreamReader):
+        try:
+            async for line in reader:
+                message = json.loads(line)
+
+                if "reply" in message:
+                    future = self._requests.get(message["reply"])
+
+                    if future is not None and not future.done():
+                        future.set_result(message["results"])
+                elif "call" in message:
+                    task = asyncio.create_task(self._answer(message))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+        except (OSError, ValueError) as e:
+            print(f"Coordination failed: {e}")
+        finally:
+            self._writer.close()
+
+            for future in self._requests.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost the connection to the other processes."))
+
+    async def _answer(self, call: Dict):
+        handler = self._handlers.get(call["op"])
 
-        items.insert(where, items.pop(what))
+        try:
+            if handler is None:
+                raise ValueError(f"Unknown operation {call['op']}")
 
-        for item in items:
-            await self.put(item)
+            answer = {"answer": call["call"], "result": await handler(**call["args"])}
+        except Exception as e:
+            answer = {"answer": call["call"], "error": str(e)}
 
+        with contextlib.suppress(ConnectionError):
+            Coordinator._send(self._writer, answer)
+            await self._writer.drain()
 
-class VoiceError(Exception):
-    pass
+    def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
 
+        for task in self._tasks:
+            task.cancel()
 
-class VoiceState:
-    def __init__(self, bot: commands.Bot, ctx: discord.ApplicationContext):
+
+class MusicBot(commands.Cog):
+    # Minimum seconds between progress updates of a playlist import
+    IMPORT_PROGRESS_INTERVAL = 2
+    # Queries of a batch `/play` resolved at the same time
+    BATCH_PARALLELISM = int(os.getenv("PLAY_BATCH_PARALLELISM", "4"))
+    # Limits of a batch `/play`
+    BATCH_MAX_QUERIES = int(os.getenv("PLAY_BATCH_MAX_QUERIES", "200"))
+    BATCH_MAX_BYTES = 64 * 1024
+    # Slash command options are a single line, so several songs typed into one are separated by this
+    BATCH_SEPARATOR = ";"
+
+    def __init__(self, bot: commands.Bot, lyrics: LyricsService = None, coordination: CoordinatorClient = None):
         self.bot = bot
-        self.ctx = ctx
+        self.lyrics = lyrics
+        # Set when this is one of several processes of a sharded bot
+        self.coordination = coordination
+        self.store = QueueStore(QueueStore.PATH) if QueueStore.PATH else None
+        self.outbox = Outbox()
+        self.now_playing = NowPlayingBoard(self.outbox)
+        self.voice_states = VoiceStateRegistry(bot, self.store, lyrics, self.now_playing)
+
+        if AudioCache.PATH:
+            YTDLSource.audio_cache = AudioCache(AudioCache.PATH)
+
+        if AudioCache.PATH and LoudnessIndex.PATH:
+            YTDLSource.loudness = LoudnessIndex(LoudnessIndex.PATH)
+        elif LoudnessIndex.PATH:
+            print("Loudness normalization is off, it only measures cached tracks and AUDIO_CACHE_PATH isn't set")
+
+        self.history = TrackHistory(TrackHistory.PATH) if TrackHistory.PATH else None
+
+        self.command_cache = CommandSyncCache(CommandSyncCache.PATH)
+        self.refresher = StreamRefresher(self.voice_states)
+        self._started = False
+
+        self.register_gauges()
+
+        if coordination is not None:
+            coordination.handle("stats", self._stats_snapshot)
+            coordination.handle("status", self._status)
+
+    def register_gauges(self):
+        def cache_counters(cache: ExtractionCache, counter: str) -> list:
+            return [({"kind": kind}, stats[counter]) for kind, stats in cache.stats().items()]
+
+        metrics.gauge("musicbot_voice_states", "Live voice states.", lambda: len(self.voice_states))
+        metrics.gauge("musicbot_outbox_pending", "Messages waiting to be sent.", lambda: len(self.outbox))
+        metrics.gauge(
+            "musicbot_stream_refreshes_total",
+            "Stream URLs refreshed ahead of expiry.",
+            lambda: [({"result": "ok"}, self.refresher.refreshed), ({"result": "failed"}, self.refresher.failed)],
+            "counter",
+        )
+        metrics.gauge(
+            "musicbot_playing_voice_states",
+            "Voice states currently playing.",
+            lambda: sum(1 for state in self.voice_states if state.current is not None),
+        )
+        metrics.gauge(
+            "musicbot_queued_songs",
+            "Songs queued over all guilds.",
+            lambda: sum(len(state.songs) for state in self.voice_states),
+        )
+        metrics.gauge(
+            "musicbot_longest_queue",
+            "Songs in the longest queue.",
+            lambda: max((len(state.songs) for state in self.voice_states), default=0),
+        )
+        metrics.gauge(
+            "musicbot_extraction_backlog", "Extractions waiting for a worker.", lambda: YTDLSource.engine.backlog
+        )
+        metrics.gauge(
+            "musicbot_extraction_running", "Extractions being run by a worker.", lambda: YTDLSource.engine.running
+        )
+        metrics.gauge(
+            "musicbot_extraction_coalesced_total",
+            "Extractions that joined an identical one already in flight.",
+            lambda: YTDLSource.inflight.coalesced,
+            "counter",
+        )
+        metrics.gauge(
+            "musicbot_extraction_cache_hits_total",
+            "Extraction cache hits.",
+            lambda: cache_counters(YTDLSource.cache, "hits"),
+            "counter",
+        )
+        metrics.gauge(
+            "musicbot_extraction_cache_misses_total",
+            "Extraction cache misses.",
+            lambda: cache_counters(YTDLSource.cache, "misses"),
+            "counter",
+        )
 
-        self.songs: SongQueue = SongQueue()
-        self.current: YTDLSource = None
-        self.should_play_next = asyncio.Event()
-        self.voice: discord.VoiceClient = None
+        if self.lyrics is not None:
+            metrics.gauge(
+                "musicbot_lyrics_cache_hits_total",
+                "Lyrics cache hits.",
+                lambda: cache_counters(self.lyrics.cache, "hits"),
+                "counter",
+            )
+            metrics.gauge(
+                "musicbot_lyrics_cache_misses_total",
+                "Lyrics cache misses.",
+                lambda: cache_counters(self.lyrics.cache, "misses"),
+                "counter",
+            )
+
+        if YTDLSource.audio_cache is not None:
+            metrics.gauge(
+                "musicbot_audio_cache_hits_total", "Audio cache hits.", lambda: YTDLSource.audio_cache.hits, "counter"
+            )
+            metrics.gauge(
+                "musicbot_audio_cache_misses_total",
+                "Audio cache misses.",
+                lambda: YTDLSource.audio_cache.misses,
+                "counter",
+            )
+            metrics.gauge("musicbot_audio_cache_bytes", "Size of the audio cache.", lambda: YTDLSource.audio_cache.size)
+
+        if YTDLSource.loudness is not None:
+            metrics.gauge(
+                "musicbot_loudness_analyses_total",
+                "Tracks whose loudness was measured.",
+                lambda: [
+                    ({"result": "ok"}, YTDLSource.loudness.analysed),
+                    ({"result": "failed"}, YTDLSource.loudness.failed),
+                ],
+                "counter",
+            )
+            metrics.gauge("musicbot_loudness_tracks", "Tracks with a known gain.", lambda: len(YTDLSource.loudness))
+
+    @commands.Cog.listener()
+    async def on_connect(self):
+        # Only takes over if the bot leaves syncing to its cogs
+        if self.bot.auto_sync_commands:
+            return
 
-        self._loop = False
-        self._volume = 0.5
+        synced = await self.command_cache.sync(self.bot)
+        print("Synced application commands" if synced else "Application commands unchanged, skipped syncing them")
 
-        self.audio_player = bot.loop.create_task(self.audio_player_task())
+    @commands.Cog.listener()
+    async def on_unknown_application_command(self, interaction: discord.Interaction):
+        # The cached command IDs went stale somehow, get the real ones
+        if not self.bot.auto_sync_commands:
+            await self.command_cache.sync(self.bot, force=True)
 
-    def __del__(self):
-        self.audio_player.cancel()
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # `on_ready` also fires after reconnects
+        if self._started:
+            return
 
-    @property
-    def loop(self):
-        return self._loop
+        self._started = True
+        startup = Metrics.process_age()
+        metrics.observe("startup", startup)
+        print(f"Ready {startup:.2f} seconds after starting")
 
-    @loop.setter
-    def loop(self, value: bool):
-        self._loop = value
+        if self.coordination is not None:
+            try:
+                await self.coordination.connect()
+            except OSError as e:
+                # Only `/stats` and `/shards` need it, and they fall back to this process
+                print(f"Couldn't connect to the other processes: {e}")
 
-    @property
-    def is_playing(self):
-        return self.voice and self.current
+        # Everything deferred to keep startup short, loaded now so the first `/play` doesn't wait for it
+        self.bot.loop.create_task(self.warm_up())
 
-    async def audio_player_task(self):
-        try:
-            while True:
-                # Clear flag
-                self.should_play_next.clear()
+        self.bot.loop.create_task(self.refresher.run())
 
-                if not self.loop:
-                    try:
-                        # Wait for three minutes (180 seconds) while inactive
-                        # before leaving the channel for performance reasons.
-                        async with timeout(180):
-                            song = await self.songs.get()
-                            self.current = song.source
-                    except asyncio.TimeoutError:
-                        # TODO: Also cleaning up this task (and the restarting
-                        #       it on play) would be nice.
-                        print("Leaving voice channel due to inactivity...")
-                        self.bot.loop.create_task(self.stop())
-                        self.current = None
+        if self.store is not None:
+            await self.restore_queues()
+            self.bot.loop.create_task(self.checkpoint_task())
 
-                if self.current is not None:
-                    try:
-                        current_player = await self.current.get_player(self._volume)
-                        self.voice.play(current_player, after=self.play_next_song)
-                        await self.current.channel.send(embed=self.current.create_embed())
-                    except Exception as e:
-                        # TODO: Better video unavailable handling (catching a lot of possible exceptions here)
-                        print(e)
-                        self.play_next_song()
+        if Metrics.PORT:
+            try:
+                await metrics.serve(Metrics.HOST, Metrics.PORT)
+            except OSError as e:
+                # Playback doesn't depend on it, `/stats` still works
+                print(f"Couldn't serve metrics on {Metrics.HOST}:{Metrics.PORT}: {e}")
+
+    async def warm_up(self):
+        loop = asyncio.get_running_loop()
 
-                # Wait until the `after=play_next_song` sets the `self.should_play_next` flag again
-                await self.should_play_next.wait()
+        try:
+            with metrics.time("warm_up"):
+                await asyncio.gather(
+                    YTDLSource.engine.warm_up(loop),
+                    loop.run_in_executor(None, importlib.import_module, "bs4"),
+                    loop.run_in_executor(None, importlib.import_module, "mutagen"),
+                )
         except Exception as e:
-            print(e)
+            # Not fatal, whatever failed is loaded (or fails again) once it's needed
+            print(f"Warming up failed: {e}")
+
+    async def restore_queues(self):
+        for guild_id, saved in (await self.store.load()).items():
+            guild = self.bot.get_guild(guild_id)
+
+            if guild is None:
+                # Not our guild (anymore)
+                continue
+
+            if guild.get_channel(saved["voice_channel_id"] or 0) is None:
+                # Kept until the guild starts a new queue, in case the channel comes back
+                print(f"Not restoring the queue of guild {guild_id}, its voice channel is gone")
+                continue
+
+            state = self.voice_states.get_or_create(guild_id)
+
+            try:
+                await state.restore(guild, saved)
+                print(f"Restored {len(saved['queued'])} queued songs in guild {guild_id}")
+            except Exception as e:
+                # Possibly just a hiccup connecting, so the saved queue stays for the next start
+                print(f"Couldn't restore the queue of guild {guild_id}: {e}")
+                state.detach_store()
+                await self.voice_states.evict(guild_id)
+
+    async def checkpoint_task(self):
+        while True:
+            await asyncio.sleep(QueueStore.CHECKPOINT_INTERVAL)
+
+            for state in self.voice_states:
+                if state.current is not None and state.current.time_elapsed_timer is not None:
+                    self.store.update_elapsed(state.guild_id, state.position, state.loop)
+
+    async def _stats_snapshot(self) -> Dict:
+        return metrics.snapshot()
+
+    async def _status(self) -> Dict:
+        shards = sorted(self.bot.shards) if isinstance(self.bot, discord.AutoShardedClient) else []
+
+        return {
+            "shards": shards,
+            "guilds": len(self.bot.guilds),
+            "voice_states": len(self.voice_states),
+            "latency": self.bot.latency,
+        }
+
+    async def gather(self, op: str, local) -> tuple:
+        # Answers of every process of a sharded bot, or just this one's, and what went wrong getting them
+        if self.coordination is None:
+            return [{"worker": 0, "result": await local()}], []
 
-    def play_next_song(self, error=None):
-        if error:
-            raise VoiceError(str(error))
+        try:
+            results = await self.coordination.request(op)
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            return [{"worker": self.coordination.worker, "result": await local()}], [str(e) or "Timed out"]
 
-        self.should_play_next.set()
+        errors = [f"Worker {result['worker']}: {result['error']}" for result in results if "error" in result]
+        return [result for result in results if "result" in result], errors
 
-    def skip(self):
-        if self.is_playing:
-            self.voice.stop()
+    def get_voice_state(self, ctx: discord.ApplicationContext):
+        return self.voice_states.get(ctx)
 
-    async def stop(self):
-        self.songs.clear()
+    def cog_unload(self):
+        self.voice_states.close_all()
+        self.now_playing.close()
+        self.outbox.close()
+        YTDLSource.engine.close()
 
-        if self.voice:
-            await self.voice.disconnect()
-            self.voice = None
+        if self.coordination is not None:
+            self.coordination.close()
 
+        self.bot.loop.create_task(metrics.close())
 
-class MusicBot(commands.Cog):
-    def __init__(self, bot: commands.Bot):
-        self.bot = bot
-        self.voice_state = None
+        if YTDLSource.audio_cache is not None:
+            YTDLSource.audio_cache.close()
 
-    def get_voice_state(self, ctx: discord.ApplicationContext):
-        if not self.voice_state:
-            self.voice_state = VoiceState(self.bot, ctx)
+        if YTDLSource.loudness is not None:
+            YTDLSource.loudness.close()
 
-        return self.voice_state
+        if self.history is not None:
+            self.history.close()
 
-    def cog_unload(self):
-        self.bot.loop.create_task(self.voice_state.stop())
+        if self.lyrics is not None:
+            self.bot.loop.create_task(self.lyrics.close())
 
     def cog_check(self, ctx: discord.ApplicationContext):
         if not ctx.guild:
@@ -377,7 +3848,7 @@ class MusicBot(commands.Cog):
             await ctx.interaction.followup.send(f":red_square: An error occurred: {str(error)}")
         except Exception:
             # Probably no interaction to follow up on
-            await ctx.send(f":red_square: An error occurred: {str(error)}")
+            await self.outbox.send(ctx.channel, Outbox.URGENT, content=f":red_square: An error occurred: {str(error)}")
 
     @commands.slash_command(name="join", invoke_without_subcommand=True)
     async def _join(self, ctx: discord.ApplicationContext):
@@ -387,9 +3858,12 @@ class MusicBot(commands.Cog):
 
         if ctx.voice_state.voice:
             await ctx.voice_state.voice.move_to(destination)
-            return
+        else:
+            ctx.voice_state.voice = await destination.connect()
 
-        ctx.voice_state.voice = await destination.connect()
+        # Where a restored queue plays, even if the bot restarts before anything does
+        if self.store is not None:
+            self.store.set_voice_channel(ctx.guild.id, destination.id)
 
     @commands.slash_command(name="leave", aliases=["disconnect"])
     # @commands.has_permissions(manage_guild=True) TODO: Permissions?
@@ -400,23 +3874,84 @@ class MusicBot(commands.Cog):
             await ctx.respond("The bot isn't connected to a voice channel.", ephemeral=True)
             return
 
-        await ctx.voice_state.stop()
-        del self.voice_state
+        await self.voice_states.evict(ctx.guild.id)
+        await ctx.respond(":wave: Bye!")
 
     @commands.slash_command(name="volume")
     async def _volume(self, ctx: discord.ApplicationContext, *, volume: int):
-        """(DOESN'T WORK) Adjusts the bot volume. Accepts values from 0 to 100."""
+        """Adjusts the bot volume. Accepts values from 0 to 100."""
 
         if not ctx.voice_state.is_playing:
             await ctx.respond("The bot isn't playing at the moment.")
             return
 
-        if 0 > volume > 100:
+        if not 0 <= volume <= 100:
             await ctx.respond("The volume value must be between 0 and 100.")
             return
 
-        ctx.voice_state.volume = volume / 100
-        await ctx.respond(f"Volume of the player has been set to {volume}")
+        await ctx.interaction.response.defer()
+        await ctx.voice_state.set_volume(volume / 100)
+        await ctx.interaction.followup.send(f"Volume of the player has been set to {volume}")
+
+    @commands.slash_command(name="stats")
+    @discord.default_permissions(administrator=True)
+    async def _stats(self, ctx: discord.ApplicationContext):
+        """Shows playback pipeline latencies and load."""
+
+        await ctx.defer(ephemeral=True)
+
+        results, errors = await self.gather("stats", self._stats_snapshot)
+        snapshot = Metrics.merge([result["result"] for result in results])
+
+        embed = discord.Embed(title="Stats", color=discord.Color.blurple())
+
+        if self.coordination is not None:
+            embed.description = f"Added up over {len(results)} processes"
+
+        for stage, stats in metrics.stages(snapshot["histograms"]).items():
+            embed.add_field(
+                name=stage,
+                value=f"{stats['count']} times\n~{stats['average'] * 1000:.0f} ms\np95 ≤ {stats['p95'] * 1000:.0f} ms",
+            )
+
+        gauges = []
+
+        for name, values in snapshot["values"].items():
+            for labels, value in values:
+                suffix = "".join(f" ({label})" for label in labels.values())
+                gauges.append(f"`{name.removeprefix('musicbot_')}{suffix}`: {value}")
+
+        embed.add_field(name="Load", value="\n".join(gauges), inline=False)
+
+        if errors:
+            embed.add_field(name="Missing", value="\n".join(errors), inline=False)
+
+        await ctx.respond(embed=embed, ephemeral=True)
+
+    @commands.slash_command(name="shards")
+    @discord.default_permissions(administrator=True)
+    async def _shards(self, ctx: discord.ApplicationContext):
+        """Shows which process runs which shards, and how busy they are."""
+
+        await ctx.defer(ephemeral=True)
+
+        results, errors = await self.gather("status", self._status)
+        embed = discord.Embed(title="Shards", color=discord.Color.blurple())
+
+        for result in sorted(results, key=lambda result: result["worker"]):
+            status = result["result"]
+            shards = ", ".join(map(str, status["shards"])) or "none"
+            latency = f"{status['latency'] * 1000:.0f} ms" if math.isfinite(status["latency"]) else "unknown"
+
+            embed.add_field(
+                name=f"Process {result['worker']}",
+                value=f"Shards {shards}\n{status['guilds']} guilds\n{status['voice_states']} voice states\n{latency}",
+            )
+
+        if errors:
+            embed.add_field(name="Not answering", value="\n".join(errors), inline=False)
+
+        await ctx.respond(embed=embed, ephemeral=True)
 
     @commands.slash_command(name="np")
     async def _np(self, ctx: discord.ApplicationContext):
@@ -426,7 +3961,9 @@ class MusicBot(commands.Cog):
             await ctx.respond("Nothing is playing right now :(.", ephemeral=True)
             return
 
-        await ctx.respond(embed=ctx.voice_state.current.create_embed())
+        # Brought down here instead of posting yet another one
+        await ctx.respond(":arrow_down: Now playing:", ephemeral=True)
+        await self.now_playing.move(ctx.voice_state, ctx.channel)
 
     # TODO: Pausing while paused?
     @commands.slash_command(name="pause")
@@ -440,6 +3977,7 @@ class MusicBot(commands.Cog):
         if ctx.voice_state.voice.is_playing():
             ctx.voice_state.voice.pause()
             ctx.voice_state.current.time_elapsed_timer.pause()
+            self.now_playing.refresh(ctx.guild.id)
             await ctx.respond(":pause_button: Paused... for now!")
         else:
             await ctx.respond("I'm not playing, dum dum!", ephemeral=True)
@@ -455,10 +3993,43 @@ class MusicBot(commands.Cog):
         if ctx.voice_state.voice.is_paused():
             ctx.voice_state.voice.resume()
             ctx.voice_state.current.time_elapsed_timer.unpause()
+            self.now_playing.refresh(ctx.guild.id)
             await ctx.respond(":arrow_forward: Yay!")
         else:
             await ctx.respond("I'm not paused, dummy!", ephemeral=True)
 
+    @commands.slash_command(name="seek")
+    async def _seek(self, ctx: discord.ApplicationContext, position: str):
+        """Jumps to a position in the current song, like 90, 1:30 or 1:01:30."""
+
+        if not ctx.voice_state.is_playing:
+            await ctx.respond("The bot isn't playing, dum dum!", ephemeral=True)
+            return
+
+        try:
+            seconds = YTDLSource.parse_time(position)
+        except ValueError:
+            await ctx.respond("That's not a position, try something like 1:30.", ephemeral=True)
+            return
+
+        await ctx.interaction.response.defer()
+        seconds = await ctx.voice_state.seek(seconds)
+        progress = ctx.voice_state.current.progress(seconds) or f"{seconds:.0f}s"
+        await ctx.interaction.followup.send(f":fast_forward: Jumped to {progress}")
+
+    @commands.slash_command(name="rewind")
+    async def _rewind(self, ctx: discord.ApplicationContext, seconds: int = 10):
+        """Goes back some seconds in the current song, 10 by default."""
+
+        if not ctx.voice_state.is_playing:
+            await ctx.respond("The bot isn't playing, dum dum!", ephemeral=True)
+            return
+
+        await ctx.interaction.response.defer()
+        position = await ctx.voice_state.seek(ctx.voice_state.position - seconds)
+        progress = ctx.voice_state.current.progress(position) or f"{position:.0f}s"
+        await ctx.interaction.followup.send(f":rewind: Back to {progress}")
+
     @commands.slash_command(name="stop")
     async def _stop(self, ctx: discord.ApplicationContext):
         """Stops playing and clears the queue."""
@@ -468,7 +4039,8 @@ class MusicBot(commands.Cog):
             return
 
         ctx.voice_state.songs.clear()
-        ctx.voice_state.voice.stop()
+        # Through `skip`, so it doesn't look like the song broke off
+        ctx.voice_state.skip()
         await ctx.respond(":stop_button: :(")
 
     @commands.slash_command(name="clear")
@@ -582,42 +4154,218 @@ class MusicBot(commands.Cog):
         else:
             await ctx.respond(":arrow_forward: Playing the rest of the queue!")
 
+    async def suggest_tracks(self, ctx: discord.AutocompleteContext) -> List[discord.OptionChoice]:
+        if self.history is None or ctx.interaction.guild_id is None:
+            return []
+
+        return await self.history.suggest(ctx.interaction.guild_id, ctx.value or "")
+
+    async def from_history(self, ctx: discord.ApplicationContext, query: str) -> Optional[YTDLSource]:
+        # A track played here before, by its URL (as picked from the suggestions) or the name it was found by
+        if self.history is None:
+            return None
+
+        data = await self.history.resolve(ctx.guild.id, query)
+        return YTDLSource(ctx, data) if data is not None else None
+
+    async def remember(self, ctx: discord.ApplicationContext, source: YTDLSource):
+        if self.history is not None:
+            await self.history.record(ctx.guild.id, source)
+
     @commands.slash_command(name="play")
-    async def _play(self, ctx: discord.ApplicationContext, *, name_or_url: str):
+    @discord.option(
+        "name_or_url", str, description=f"A song's name or URL, or several separated by {BATCH_SEPARATOR}",
+        required=False, default=None, autocomplete=suggest_tracks,
+    )
+    async def _play(
+        self,
+        ctx: discord.ApplicationContext,
+        *,
+        name_or_url: str = None,
+        file: discord.Attachment = None,
+    ):
         """
         Plays a song. You can either provide a URL, or the name of the song.
 
         If there are songs in the queue, this will be queued until theother songs finished playing.
         This command automatically searches from various sites if no URL is provided.
         A list of these sites can be found here: https://rg3.github.io/youtube-dl/supportedsites.html
+
+        Several songs can be added at once, separated by semicolons, or from a text file with one per line.
         """
 
         await ctx.interaction.response.defer()
         print(name_or_url)
 
+        queries = [query.strip() for query in (name_or_url or "").split(self.BATCH_SEPARATOR) if query.strip()]
+
+        if file is not None:
+            if file.size > self.BATCH_MAX_BYTES:
+                await ctx.interaction.followup.send(f":red_square: That file is too big, the limit is {self.BATCH_MAX_BYTES // 1024} KB.")  # noqa: E501
+                return
+
+            text = (await file.read()).decode(errors="replace")
+            queries.extend(line.strip() for line in text.splitlines() if line.strip())
+
+        if not queries:
+            await ctx.interaction.followup.send(":red_square: Tell me what to play, or attach a list of songs.")
+            return
+
+        if len(queries) > self.BATCH_MAX_QUERIES:
+            await ctx.interaction.followup.send(f":red_square: That's too many songs at once, the limit is {self.BATCH_MAX_QUERIES}.")  # noqa: E501
+            return
+
         # TODO: Might need to check whether the voice_state is in a channel here too
         if not ctx.voice_state.voice:
             await ctx.invoke(self._join)
 
+        if len(queries) == 1:
+            await self.import_one(ctx, queries[0])
+        else:
+            await self.import_batch(ctx, queries)
+
+    async def import_one(self, ctx: discord.ApplicationContext, name_or_url: str):
+        songs = ctx.voice_state.songs
+        # `/stop` and `/clear` bump this, which cancels the import
+        generation = songs.generation
+        known = await self.from_history(ctx, name_or_url)
+
+        if known is not None:
+            # Nothing to search for, the stream is resolved once it's about to play
+            await songs.put(Song(known))
+            await ctx.interaction.followup.send(f":white_check_mark: Added {str(known)} to the queue!")
+            await self.remember(ctx, known)
+            return
+
+        added = 0
+        message = None
+        last_update = time.monotonic()
+
         # async with ctx.typing():
         # No point in doing `with typing` here, as defering already shows an indeterminate progress
         try:
-            pre_sources = await YTDLSource.prepare_sources(ctx, name_or_url, loop=self.bot.loop)
+            batches = YTDLSource.iter_sources(ctx, name_or_url, loop=self.bot.loop)
+
+            async with contextlib.aclosing(batches):
+                async for pre_sources in batches:
+                    if songs.generation != generation:
+                        await self.send_or_edit(ctx, message, f":stop_button: Stopped importing after {added} songs.")
+                        return
+
+                    for pre_source in pre_sources:
+                        song = Song(pre_source)
+                        await songs.put(song)
+
+                    added += len(pre_sources)
+
+                    if added > 1 and time.monotonic() - last_update >= self.IMPORT_PROGRESS_INTERVAL:
+                        message = await self.send_or_edit(ctx, message, f":hourglass: Added {added} songs so far...")
+                        last_update = time.monotonic()
         except YTDLError as e:
-            await ctx.interaction.followup.send(f":red_square: An error occurred while processing this request: {str(e)}")  # noqa: E501
+            if added == 0:
+                await ctx.interaction.followup.send(f":red_square: An error occurred while processing this request: {str(e)}")  # noqa: E501
+            else:
+                await self.send_or_edit(
+                    ctx, message, f":warning: Added {added} songs, but then this happened: {str(e)}"
+                )
         else:
-            for pre_source in pre_sources:
-                song = Song(pre_source)
-                await ctx.voice_state.songs.put(song)
-
-            if len(pre_sources) == 1:
-                await ctx.interaction.followup.send(f":white_check_mark: Added {str(pre_source)} to the queue!")
+            if added == 1:
+                await self.send_or_edit(ctx, message, f":white_check_mark: Added {str(pre_source)} to the queue!")
+                await self.remember(ctx, pre_source)
             else:
-                await ctx.interaction.followup.send(f":white_check_mark: Added {len(pre_sources)} songs to the queue!")
+                await self.send_or_edit(ctx, message, f":white_check_mark: Added {added} songs to the queue!")
 
             # if not ctx.voice_state.is_playing:
             #     ctx.voice_state.play_next_song()
 
+    async def import_batch(self, ctx: discord.ApplicationContext, queries: List[str]):
+        songs = ctx.voice_state.songs
+        generation = songs.generation
+        semaphore = asyncio.Semaphore(self.BATCH_PARALLELISM)
+
+        async def resolve(query: str) -> List[YTDLSource]:
+            async with semaphore:
+                if songs.generation != generation:
+                    return []
+
+                known = await self.from_history(ctx, query)
+
+                if known is not None:
+                    return [known]
+
+                return await YTDLSource.prepare_sources(ctx, query, loop=self.bot.loop)
+
+        # Resolved concurrently, but queued in the order they were given
+        tasks = [asyncio.create_task(resolve(query)) for query in queries]
+
+        added = 0
+        failed = []
+        message = None
+        last_update = time.monotonic()
+
+        try:
+            for query, task in zip(queries, tasks):
+                try:
+                    sources = await task
+                except Exception as e:
+                    # Anything can go wrong with a single one, that shouldn't stop the rest
+                    failed.append((query, str(e)))
+                    continue
+
+                if songs.generation != generation:
+                    await self.send_or_edit(ctx, message, f":stop_button: Stopped importing after {added} songs.")
+                    return
+
+                for source in sources:
+                    await songs.put(Song(source))
+
+                if len(sources) == 1:
+                    await self.remember(ctx, sources[0])
+
+                added += len(sources)
+
+                if time.monotonic() - last_update >= self.IMPORT_PROGRESS_INTERVAL:
+                    message = await self.send_or_edit(ctx, message, f":hourglass: Added {added} songs so far...")
+                    last_update = time.monotonic()
+        finally:
+            for task in tasks:
+                if task.done() and not task.cancelled():
+                    # Keeps asyncio from complaining about failures nobody looked at after stopping early
+                    task.exception()
+
+                task.cancel()
+
+        summary = f"Added {added} songs from {len(queries) - len(failed)} of {len(queries)} requests."
+
+        if not failed:
+            summary = f":white_check_mark: {summary}"
+        else:
+            lines = [f"- `{query[:100]}`: {error[:200]}" for query, error in failed]
+            shown = len(lines)
+
+            # One message, however many failed
+            while shown and len(summary) + sum(len(line) + 1 for line in lines[:shown]) > 1900:
+                shown -= 1
+
+            if shown < len(lines):
+                lines = lines[:shown] + [f"...and {len(lines) - shown} more"]
+
+            summary = "\n".join([f":warning: {summary} These didn't work:"] + lines)
+
+        await self.send_or_edit(ctx, message, summary)
+
+    async def send_or_edit(self, ctx: discord.ApplicationContext, message: discord.WebhookMessage, content: str):
+        if message is None:
+            return await ctx.interaction.followup.send(content)
+
+        try:
+            await message.edit(content=content)
+        except discord.HTTPException:
+            # The interaction token only lives for 15 minutes, huge imports can outlive it
+            pass
+
+        return message
+
     @commands.slash_command(name="lyrics")
     async def _lyrics(self, ctx: discord.ApplicationContext, name: str = None):
         """Displays lyrics for the given song, or the current song if no name is provided."""
@@ -625,48 +4373,31 @@ class MusicBot(commands.Cog):
         await ctx.interaction.response.defer()
 
         if name is None:
-            song = None
-
-            if ctx.voice_state.current.original_name is not None:
-                song = genius.search_song(ctx.voice_state.current.original_name)
+            if ctx.voice_state.current is None:
+                await ctx.interaction.followup.send("Nothing is playing right now :(.")
+                return
 
-            if song is None:
-                song = genius.search_song(ctx.voice_state.current.title)
+            # Usually already cached, since it's prefetched once the song starts playing
+            title = ctx.voice_state.current.title
+            chunks = await self.lyrics.for_song(ctx.voice_state.current)
 
-            if song is None:
+            if chunks is None:
                 await ctx.interaction.followup.send(":pleading_face: Apologies, I couldn't find lyrics for the current song. Try specifying its name when searching!")  # noqa: E501
                 return
         else:
-            song = genius.search_song(name)
+            title = name
+            chunks = await self.lyrics.search(name)
 
-            if song is None:
+            if chunks is None:
                 await ctx.interaction.followup.send(f":pleading_face: Apologies, I couldn't find lyrics for {name}.")
                 return
 
         await ctx.interaction.followup.send("Here are the lyrics:\n")
-        await self.send_split_message(ctx, song.lyrics)
-
-    async def send_split_message(self, ctx: discord.ApplicationContext, message: str):
-        # The maximum message length allowed by discord
-        MAX_LENGTH = 2000
-
-        # Split the lyrics into chunks of max_length characters
-        chunks = []
-
-        while len(message) > MAX_LENGTH:
-            # Find the last newline before the max_length limit
-            split_index = message.rfind('\n', 0, MAX_LENGTH)
-
-            if split_index == -1:  # No newline found, split at max_length
-                split_index = MAX_LENGTH
-
-            chunks.append(message[:split_index])
-            message = message[split_index:]
-
-        chunks.append(message)
+        await self.send_split_message(ctx, chunks, title)
 
-        for chunk in chunks:
-            await ctx.send(chunk)
+    async def send_split_message(self, ctx: discord.ApplicationContext, chunks: List[str], title: str = None):
+        # Bulk content, it only goes out once nothing more urgent is waiting
+        await self.outbox.send_chunks(ctx.channel, chunks, title)
 
     @_join.before_invoke
     @_play.before_invoke
@@ -678,23 +4409,151 @@ class MusicBot(commands.Cog):
             raise commands.CommandError("The bot is already in a voice channel.")
 
 
-if __name__ == "__main__":
+def create_bot(
+    shard_ids: List[int] = None, shard_count: int = None, coordination: CoordinatorClient = None
+) -> commands.Bot:
     intents = discord.Intents.all()
     intents.presences = True
     intents.messages = True
     intents.message_content = True
-    bot = commands.Bot(command_prefix=commands.when_mentioned_or("!"), intents=intents)
+    options = dict(command_prefix=commands.when_mentioned_or("!"), intents=intents, auto_sync_commands=False)
+
+    if shard_count:
+        bot = commands.AutoShardedBot(shard_ids=shard_ids, shard_count=shard_count, **options)
+    else:
+        # Commands are synced by `MusicBot` instead, which skips it if they haven't changed
+        bot = commands.Bot(**options)
 
     @bot.event
     async def on_ready():
         print(f"Logged in as {bot.user.name} ({bot.user.id})")
 
-    load_dotenv()
-    bot_token = str(os.getenv("BOT_TOKEN"))
-
-    # TODO: Only in __main__?
     genius_token = str(os.getenv("GENIUS_TOKEN"))
-    genius = lyricsgenius.Genius(genius_token)
 
-    bot.add_cog(MusicBot(bot))
-    bot.run(bot_token)
+    bot.add_cog(MusicBot(bot, LyricsService(genius_token), coordination))
+    return bot
+
+
+def _run_worker(index: int, shard_ids: List[int], shard_count: int, port: int, token: str, processes: int):
+    # Entry point of the worker processes, which start from a fresh interpreter
+    print(f"Worker {index} (pid {os.getpid()}) runs shards {shard_ids} of {shard_count}")
+
+    # Machine-wide budgets are split between the processes
+    if Metrics.PORT:
+        Metrics.PORT += index
+
+    if AudioCache.PATH:
+        AudioCache.PATH = AudioCache.worker_path(AudioCache.PATH, index)
+        AudioCache.MAX_BYTES //= processes
+
+    bot = create_bot(shard_ids, shard_count, CoordinatorClient(port, token, index))
+    bot.run(str(os.getenv("BOT_TOKEN")))
+
+
+class ShardLauncher:
+    # Runs the bot as several processes with a share of the shards each, so it isn't limited to one core.
+    # 0 runs a single unsharded bot, "auto" asks Discord how many shards it recommends.
+    SHARD_COUNT = os.getenv("SHARD_COUNT", "0")
+    # Worker processes, no more than there are shards
+    PROCESSES = int(os.getenv("SHARD_PROCESSES", "0")) or os.cpu_count() or 1
+    # Seconds before a crashed worker is started again
+    RESTART_DELAY = 5
+    # Seconds between starting workers, Discord only lets one shard identify at a time
+    START_INTERVAL = 5
+    # Seconds a worker gets to shut down cleanly before it's killed
+    STOP_TIMEOUT = 10
+
+    def __init__(self, bot_token: str):
+        self.bot_token = bot_token
+
+    async def recommended_shards(self) -> int:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(
+                "https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {self.bot_token}"}
+            ) as response:
+                response.raise_for_status()
+                return (await response.json())["shards"]
+
+    def run(self):
+        shard_count = asyncio.run(self.recommended_shards()) if self.SHARD_COUNT == "auto" else int(self.SHARD_COUNT)
+        processes = min(self.PROCESSES, shard_count)
+
+        if processes <= 1:
+            # Sharded or not, a single process doesn't need anything to coordinate with
+            create_bot(shard_count=shard_count or None).run(self.bot_token)
+        else:
+            asyncio.run(self.supervise(shard_count, processes))
+
+    async def supervise(self, shard_count: int, processes: int):
+        loop = asyncio.get_running_loop()
+        coordinator = Coordinator(secrets.token_hex(16))
+        await coordinator.start()
+
+        if AudioCache.PATH:
+            AudioCache.prune_workers(AudioCache.PATH, processes)
+
+        # A fresh interpreter per worker, forking would copy the parent's event loop
+        context = multiprocessing.get_context("spawn")
+        shard_ids = list(range(shard_count))
+
+        def start(index: int) -> multiprocessing.Process:
+            # Spread round-robin, so every worker gets a similar share of the guilds
+            args = (index, shard_ids[index::processes], shard_count, coordinator.port, coordinator.token, processes)
+            # Not daemonic, workers need children of their own with `EXTRACTION_MODE=process`.
+            # Stopped explicitly below instead.
+            process = context.Process(target=_run_worker, args=args, name=f"musicbot-worker-{index}")
+            process.start()
+            return process
+
+        stopping = asyncio.Event()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            with contextlib.suppress(NotImplementedError):
+                loop.add_signal_handler(signum, stopping.set)
+
+        print(f"Running {shard_count} shards in {processes} processes")
+        workers: Dict[int, multiprocessing.Process] = {}
+        # worker index -> when it was found dead
+        crashed: Dict[int, float] = {}
+
+        try:
+            for index in range(processes):
+                workers[index] = start(index)
+
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(stopping.wait(), self.START_INTERVAL)
+
+                if stopping.is_set():
+                    return
+
+            while not stopping.is_set():
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(stopping.wait(), 1)
+
+                for index, process in workers.items():
+                    if process.is_alive():
+                        continue
+
+                    if index not in crashed:
+                        print(f"Worker {index} exited with code {process.exitcode}, restarting it")
+                        crashed[index] = time.monotonic()
+                    elif time.monotonic() - crashed[index] >= self.RESTART_DELAY and not stopping.is_set():
+                        del crashed[index]
+                        workers[index] = start(index)
+        finally:
+            for process in workers.values():
+                process.terminate()
+
+            for process in workers.values():
+                await loop.run_in_executor(None, process.join, self.STOP_TIMEOUT)
+
+                if process.is_alive():
+                    print(f"{process.name} didn't stop in time, killing it")
+                    process.kill()
+                    await loop.run_in_executor(None, process.join)
+
+            await coordinator.close()
+
+
+if __name__ == "__main__":
+    ShardLauncher(str(os.getenv("BOT_TOKEN"))).run()